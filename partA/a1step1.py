@@ -3,9 +3,26 @@
 # Names: Yorick de Boer, Julian Main, Amor Frans
 
 import argparse
+import itertools
+import multiprocessing
+import os
+import tempfile
+import tracemalloc
+import unittest
+from array import array
 from collections import Counter
+from collections import deque
 from pprint import pprint
 
+import numpy as np
+
+import instrument
+
+MAX_INT64_KEY = 2 ** 63 - 1
+SHARD_SIZE = 10000
+STREAM_LINES = 1000
+FLUSH_TOKENS = 2 ** 16
+
 
 def file_to_list(corpus):
     with open(corpus, 'r') as corpus_txt:
@@ -25,17 +42,536 @@ def count_ngrams(ngrams_list):
     return Counter(ngrams_list)
 
 
+class Vocabulary:
+    """Interns words to consecutive integer ids, in order of first occurrence"""
+
+    def __init__(self, words=()):
+        self.ids = {}
+        self.words = []
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        idx = self.ids.get(word)
+        if idx is None:
+            idx = len(self.words)
+            self.ids[word] = idx
+            self.words.append(word)
+        return idx
+
+    def encode(self, words):
+        """Returns the ids of a list of words, adding unseen words to the vocabulary"""
+        add = self.add
+        return [add(word) for word in words]
+
+    def lookup(self, words):
+        """Returns the ids of a list of words, -1 for words not in the vocabulary"""
+        get = self.ids.get
+        return [get(word, -1) for word in words]
+
+    def __getitem__(self, idx):
+        return self.words[idx]
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def __len__(self):
+        return len(self.words)
+
+
+def key_dtype(radix, sequence_size):
+    """Returns the numpy dtype able to hold ngram keys of sequence_size digits in base radix. Falls back to python
+    integers when the keys do not fit in 64 bits."""
+    if radix ** sequence_size - 1 <= MAX_INT64_KEY:
+        return np.int64
+    return object
+
+
+def count_radix(vocabulary_size):
+    """Returns the key radix of counted tables for a vocabulary size: the next power of two, so the keys of a
+    counter only need to be encoded again when its vocabulary has doubled"""
+    return 1 << max(vocabulary_size - 1, 0).bit_length()
+
+
+def encode_windows(ids, lengths, sequence_size, radix):
+    """Encodes every ngram window of a flat id array as one integer key. Windows are not allowed to cross the
+    sentence boundaries given by lengths, nor to contain negative (unknown) ids.
+    :param ids: 1d array of word ids of all sentences concatenated
+    :param lengths: 1d array with the length of every sentence
+    :return: keys of the valid windows, start positions of the valid windows in ids
+    """
+    dtype = key_dtype(radix, sequence_size)
+    num_windows = len(ids) - sequence_size + 1
+    if num_windows <= 0 or sequence_size <= 0:
+        return np.empty(0, dtype=dtype), np.empty(0, dtype=np.int64)
+
+    ids = ids.astype(dtype)
+    keys = ids[:num_windows].copy()
+    valid = ids[:num_windows] >= 0
+    for i in range(1, sequence_size):
+        digit = ids[i:i + num_windows]
+        keys *= radix
+        keys += digit
+        valid &= digit >= 0
+
+    sentence_idx = np.repeat(np.arange(len(lengths)), lengths)
+    valid &= sentence_idx[:num_windows] == sentence_idx[sequence_size - 1:]
+    positions = np.flatnonzero(valid)
+    return keys[positions], positions
+
+
+def decode_keys(keys, sequence_size, radix):
+    """Returns the 2d array of vocabulary ids of integer keys, one ngram per row"""
+    ids = np.empty((len(keys), sequence_size), dtype=np.int64)
+    keys = keys.copy()
+    for i in reversed(range(sequence_size)):
+        ids[:, i] = keys % radix
+        keys //= radix
+    return ids
+
+
+def encode_rows(ids, radix):
+    """Encodes a 2d array of ngram ids, one ngram per row, as integer keys"""
+    ids = np.asarray(ids)
+    dtype = key_dtype(radix, ids.shape[1])
+    keys = np.zeros(len(ids), dtype=dtype)
+    for i in range(ids.shape[1]):
+        keys *= radix
+        keys += ids[:, i].astype(dtype)
+    return keys
+
+
+def merge_counts(keys, counts):
+    """Sums the counts of equal keys, returns the unique sorted keys and their counts"""
+    if len(keys) == 0:
+        return keys, counts
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    counts = counts[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+class NgramTable:
+    """Compact replacement for a dictionary of ngram tuples. Words are interned to integer ids and every ngram is
+    stored as one integer key (the ids as digits in base radix). The keys are kept sorted, with a parallel array
+    of values (counts or probabilities), so a lookup is a binary search.
+
+    Behaves like the dictionaries returned by dict(Counter(ngrams)): get(), [], in, len(), iteration over ngram
+    tuples, items() and values()."""
+
+    def __init__(self, vocabulary, sequence_size, keys, values, radix=None):
+        self.vocabulary = vocabulary
+        self.sequence_size = sequence_size
+        self.radix = max(len(vocabulary), 1) if radix is None else radix
+        self.key_array = keys
+        self.value_array = values
+
+    @classmethod
+    def from_sentences(cls, sentences, sequence_size, vocabulary=None):
+        """Counts the ngrams of every sentence separately, sentences are lists of words"""
+        if vocabulary is None:
+            vocabulary = Vocabulary()
+        ids = array('q')
+        lengths = array('q')
+        for sentence in sentences:
+            ids.extend(vocabulary.encode(sentence))
+            lengths.append(len(sentence))
+
+        radix = max(len(vocabulary), 1)
+        keys, _ = encode_windows(np.frombuffer(ids, dtype=np.int64), np.frombuffer(lengths, dtype=np.int64),
+                                 sequence_size, radix)
+        keys, counts = np.unique(keys, return_counts=True)
+        return cls(vocabulary, sequence_size, keys, counts.astype(np.int64), radix)
+
+    @classmethod
+    def from_mapping(cls, mapping, vocabulary=None):
+        """Creates a table from a dictionary with ngram tuples of equal length as keys"""
+        if vocabulary is None:
+            vocabulary = Vocabulary()
+        ngram_ids = [vocabulary.encode(ngram) for ngram in mapping]
+        sequence_size = len(ngram_ids[0]) if ngram_ids else 1
+        radix = max(len(vocabulary), 1)
+
+        keys = encode_rows(np.array(ngram_ids, dtype=np.int64).reshape(-1, sequence_size), radix)
+        values = np.array(list(mapping.values()))
+        order = np.argsort(keys, kind='stable')
+        return cls(vocabulary, sequence_size, keys[order], values[order], radix)
+
+    def encode(self, ngram):
+        """Returns the integer key of an ngram, None if the ngram can not be in this table"""
+        if len(ngram) != self.sequence_size:
+            return None
+        ids = self.vocabulary.ids
+        radix = self.radix
+        key = 0
+        for word in ngram:
+            idx = ids.get(word)
+            if idx is None or idx >= radix:
+                return None
+            key = key * radix + idx
+        return key
+
+    def decode(self, key):
+        """Returns the ngram tuple of an integer key"""
+        key = int(key)
+        ids = []
+        for _ in range(self.sequence_size):
+            key, idx = divmod(key, self.radix)
+            ids.append(idx)
+        words = self.vocabulary.words
+        return tuple(words[idx] for idx in reversed(ids))
+
+    def index(self, ngram):
+        """Returns the position of an ngram in the key array, None if not present"""
+        key = self.encode(ngram)
+        if key is None:
+            return None
+        pos = int(np.searchsorted(self.key_array, key))
+        if pos < len(self.key_array) and self.key_array[pos] == key:
+            return pos
+        return None
+
+    def get(self, ngram, default=None):
+        pos = self.index(ngram)
+        if pos is None:
+            return default
+        return self.value_array[pos].item()
+
+    def __getitem__(self, ngram):
+        pos = self.index(ngram)
+        if pos is None:
+            raise KeyError(ngram)
+        return self.value_array[pos].item()
+
+    def __contains__(self, ngram):
+        return self.index(ngram) is not None
+
+    def __len__(self):
+        return len(self.key_array)
+
+    def __iter__(self):
+        return (self.decode(key) for key in self.key_array)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return self.value_array.tolist()
+
+    def items(self):
+        return zip(iter(self), self.values())
+
+    def lookup_keys(self, keys, default=0):
+        """Vectorized get for an array of integer keys encoded with this table's radix"""
+        if len(self.key_array) == 0:
+            return np.full(len(keys), default, dtype=np.result_type(self.value_array, type(default)))
+        pos = np.minimum(np.searchsorted(self.key_array, keys), len(self.key_array) - 1)
+        return np.where(self.key_array[pos] == keys, self.value_array[pos], default)
+
+    def lookup_ids(self, ids, default=0):
+        """Vectorized get for a 2d array with one ngram of vocabulary ids per row. Rows holding ids that are not
+        in this table's vocabulary, like -1 for unknown words, get the default."""
+        ids = np.asarray(ids)
+        known = ((ids >= 0) & (ids < self.radix)).all(axis=1)
+        values = self.lookup_keys(encode_rows(np.where(known[:, None], ids, 0), self.radix), default)
+        return np.where(known, values, default)
+
+    def id_matrix(self):
+        """Returns the ngrams as a 2d array of vocabulary ids, one ngram per row in key order"""
+        return decode_keys(self.key_array, self.sequence_size, self.radix)
+
+    def total(self):
+        return self.value_array.sum().item()
+
+    def most_common(self, m=None):
+        """Returns the m ngrams with the highest values like Counter.most_common"""
+        order = np.argsort(-self.value_array, kind='stable')
+        if m is not None:
+            order = order[:m]
+        return [(self.decode(self.key_array[pos]), self.value_array[pos].item()) for pos in order]
+
+
+class NgramCounter:
+    """Counts ngrams incrementally, sentence by sentence. The ids of the sentences are buffered in an array and
+    counted a buffer at a time with encode_windows and merge_counts, then inserted into sorted arrays of integer
+    keys and counts. The buffer grows with the number of distinct ngrams, so inserting it stays linear in the
+    corpus. Keys use the radix of count_radix. When more than max_entries distinct ngrams are held they are spilled
+    to a temporary file as a run of ids and counts, so memory stays bounded. finish() merges all runs into one
+    NgramTable."""
+
+    def __init__(self, sequence_size, vocabulary=None, max_entries=None, spill_dir=None):
+        self.sequence_size = sequence_size
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.radix = 1
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.runs = []  # Paths of spilled or added runs
+        self._ids = array('q')
+        self._lengths = array('q')
+        self._tmpdir = None
+        self._num_runs = 0
+
+    def update(self, sentence):
+        """Counts the ngrams of one sentence, a list of words"""
+        self.update_ids(self.vocabulary.encode(sentence))
+
+    def update_ids(self, ids):
+        """Counts the ngrams of one sentence which is already encoded to vocabulary ids"""
+        if self.sequence_size <= 0:
+            return
+        self._ids.extend(ids)
+        self._lengths.append(len(ids))
+        limit = max(FLUSH_TOKENS, len(self.keys) // 4)
+        if self.max_entries is not None:
+            limit = min(limit, self.max_entries)
+        if len(self._ids) >= limit:
+            self.flush()
+
+    def flush(self):
+        """Counts the buffered sentences into the keys and counts held in memory, spills them when there are more
+        than max_entries"""
+        if not self._ids:
+            return
+        self._set_radix(count_radix(len(self.vocabulary)))
+        keys, _ = encode_windows(np.frombuffer(self._ids, dtype=np.int64),
+                                 np.frombuffer(self._lengths, dtype=np.int64), self.sequence_size, self.radix)
+        self._ids = array('q')
+        self._lengths = array('q')
+        self._add_counts(*merge_counts(keys, np.ones(len(keys), dtype=np.int64)))
+        if self.max_entries is not None and len(self.keys) > self.max_entries:
+            self.spill()
+
+    def _set_radix(self, radix):
+        if radix != self.radix:
+            # A larger radix keeps the order of the keys, they only need to be encoded again
+            self.keys = encode_rows(decode_keys(self.keys, self.sequence_size, self.radix), radix)
+            self.radix = radix
+
+    def _add_counts(self, keys, counts):
+        """Adds unique sorted keys and their counts to the ones held in memory, without sorting them again: the
+        counts of known keys are added in place and the new keys are inserted"""
+        positions = np.searchsorted(self.keys, keys)
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self.keys):
+            found = self.keys[np.minimum(positions, len(self.keys) - 1)] == keys
+        self.counts[positions[found]] += counts[found]
+        positions, keys, counts = positions[~found], keys[~found], counts[~found]
+        self.keys = np.insert(self.keys, positions, keys)
+        self.counts = np.insert(self.counts, positions, counts)
+
+    def add_run(self, ids, counts):
+        """Adds counts which were made elsewhere, ids is a 2d array with one ngram of vocabulary ids per row. The
+        run is written to disk, so the runs of a long stream of shards are not held in memory."""
+        self.runs.append(self._save_run(ids, counts))
+
+    def spill(self):
+        """Writes the counts held in memory to a temporary file and clears them"""
+        self.flush()
+        if not len(self.keys):
+            return
+        self.runs.append(self._save_run(decode_keys(self.keys, self.sequence_size, self.radix), self.counts))
+        # Keys of a large radix may not fit in 64 bits, the radix is kept
+        self.keys = np.empty(0, dtype=key_dtype(self.radix, self.sequence_size))
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def _run_path(self):
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix='ngrams', dir=self.spill_dir)
+        self._num_runs += 1
+        return os.path.join(self._tmpdir.name, 'run{0}.npz'.format(self._num_runs))
+
+    def _save_run(self, ids, counts):
+        path = self._run_path()
+        np.savez(path, ids=ids, counts=counts)
+        return path
+
+    def finish(self, pool=None):
+        """Merges all runs into an NgramTable. The runs are added to the counts in memory one by one, so only one
+        run is loaded at a time. With a process pool they are first merged pairwise as a tree on disk, every worker
+        loads one pair of runs and writes the merged run."""
+        self.flush()
+        radix = count_radix(len(self.vocabulary))
+        self._set_radix(radix)
+        if pool is not None:
+            while len(self.runs) > 1:
+                tasks = [(path_a, path_b, self._run_path(), radix, self.sequence_size)
+                         for path_a, path_b in zip(self.runs[0::2], self.runs[1::2])]
+                merged = pool.map(_merge_run_files, tasks)
+                self.runs = merged + self.runs[len(merged) * 2:]
+        for path in self.runs:
+            self._add_counts(*load_run(path, radix))
+        keys, counts = self.keys, self.counts
+
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
+            self._tmpdir = None
+        self.runs = []
+        self.radix = 1
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        return NgramTable(self.vocabulary, self.sequence_size, keys, counts, radix)
+
+
+def load_run(path, radix):
+    """Reads a run of ids and counts written by NgramCounter as unique sorted keys and counts, removes the file"""
+    with np.load(path) as arrays:
+        ids, counts = arrays['ids'], arrays['counts']
+    os.remove(path)
+    return merge_counts(encode_rows(ids, radix), counts)
+
+
+def _merge_run_files(task):
+    """Merges two runs on disk into a new run, returns its path"""
+    path_a, path_b, path, radix, sequence_size = task
+    keys_a, counts_a = load_run(path_a, radix)
+    keys_b, counts_b = load_run(path_b, radix)
+    keys, counts = merge_counts(np.concatenate((keys_a, keys_b)), np.concatenate((counts_a, counts_b)))
+    np.savez(path, ids=decode_keys(keys, sequence_size, radix), counts=counts)
+    return path
+
+
+def ordered_imap(pool, func, tasks, max_pending):
+    """Like Pool.imap, but takes tasks from the iterable only when fewer than max_pending are in flight, so a
+    long stream of tasks is never read ahead into memory. Results are yielded in task order."""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _count_shard(task):
+    """Counts one shard of sentences in a worker with its own vocabulary"""
+    sentences, sequence_sizes = task
+    vocabulary = Vocabulary()
+    tables = count_sentences(sentences, sequence_sizes, vocabulary)
+    return vocabulary.words, [(table.id_matrix(), table.value_array) for table in tables]
+
+
+def count_sentences(sentences, sequence_sizes, vocabulary=None, max_entries=None, workers=1,
+                    chunk_size=SHARD_SIZE):
+    """Counts the ngrams of several sizes in one pass over an iterable of sentences, returns one NgramTable per
+    sequence size. All tables share one vocabulary.
+
+    With more than one worker the sentences are cut in shards of chunk_size sentences that are counted in worker
+    processes. Shard vocabularies are added to the shared vocabulary in shard order, so ids and counts are the
+    same as when counting serially."""
+    if vocabulary is None:
+        vocabulary = Vocabulary()
+    counters = [NgramCounter(size, vocabulary, max_entries) for size in sequence_sizes]
+    if workers <= 1:
+        for sentence in sentences:
+            ids = vocabulary.encode(sentence)
+            for counter in counters:
+                counter.update_ids(ids)
+        return [counter.finish() for counter in counters]
+
+    sentences = iter(sentences)
+    shards = iter(lambda: list(itertools.islice(sentences, chunk_size)), [])
+    with multiprocessing.Pool(workers) as pool:
+        tasks = ((shard, list(sequence_sizes)) for shard in shards)
+        for words, runs in ordered_imap(pool, _count_shard, tasks, 2 * workers):
+            remap = np.array(vocabulary.encode(words), dtype=np.int64)
+            for counter, (ids, counts) in zip(counters, runs):
+                counter.add_run(remap[ids], counts)
+        return [counter.finish(pool) for counter in counters]
+
+
+def word_chunks(corpus, sequence_size, chunk_lines=SHARD_SIZE):
+    """Reads a text file in chunks of lines and yields the words of every chunk. Each chunk starts with the last
+    sequence_size - 1 words of the previous one, so counting the chunks separately also counts the ngrams that
+    cross chunk boundaries, like create_ngrams on the whole file does."""
+    carry = []
+    with open(corpus, 'r') as corpus_txt:
+        while True:
+            lines = list(itertools.islice(corpus_txt, chunk_lines))
+            if not lines:
+                break
+            words = carry + [word for line in lines for word in line.split()]
+            yield words
+            carry = words[max(len(words) - sequence_size + 1, 0):] if sequence_size > 1 else []
+
+
+def count_word_stream(corpus, sequence_size, max_entries=None, workers=1):
+    """Counts the ngrams of a text file chunk by chunk, ngrams may cross line boundaries like in create_ngrams.
+    Every chunk is a shard for the workers, without workers small chunks are read, as the counter buffers them."""
+    chunks = word_chunks(corpus, sequence_size, SHARD_SIZE if workers > 1 else STREAM_LINES)
+    return count_sentences(chunks, [sequence_size], max_entries=max_entries, workers=workers, chunk_size=1)[0]
+
+
+AUSTEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raw', 'austen.txt')
+
+
+def _peak_bytes(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class TestA1Step1(unittest.TestCase):
+    def setUp(self):
+        self.sentences = [('the cat sat on the mat ' * 3).split(), [], ['the'], 'a dog sat on the cat'.split()]
+
+    def test_counter(self):
+        for size in (1, 2, 3):
+            expected = Counter(ngram for sentence in self.sentences for ngram in create_ngrams(sentence, size))
+            # A budget of 2 spills and encodes the keys again every time the vocabulary doubles
+            for max_entries in (None, 2):
+                table = count_sentences(self.sentences, [size], max_entries=max_entries)[0]
+                self.assertEqual(dict(table), dict(expected))
+
+    def test_object_keys(self):
+        # 4-grams over a vocabulary of more than 2 ** 15 words do not fit in 64 bit keys
+        words = [str(i % 40000) for i in range(0, 40000 * 7, 7)] + ['0', '7', '14', '21']
+        sentences = [words[:20000], words[20000:]]
+        expected = Counter(ngram for sentence in sentences for ngram in create_ngrams(sentence, 4))
+        table = count_sentences(sentences, [4], max_entries=5000)[0]
+        self.assertEqual(table.key_array.dtype, object)
+        self.assertEqual(dict(table), dict(expected))
+
+    def test_workers(self):
+        sentences = self.sentences * 50
+        for size in (1, 3):
+            serial = count_sentences(sentences, [size])[0]
+            for max_entries in (None, 2):
+                table = count_sentences(sentences, [size], max_entries=max_entries, workers=2, chunk_size=7)[0]
+                self.assertEqual(dict(table), dict(serial))
+
+    @unittest.skipUnless(os.path.exists(AUSTEN), 'needs raw/austen.txt')
+    def test_memory(self):
+        # The counts are arrays of keys, an order of magnitude smaller than a Counter of word tuples. Most trigrams
+        # of the corpus are distinct, so the table that is returned limits the gain.
+        for size, gain in ((2, 8), (3, 5)):
+            baseline = _peak_bytes(lambda: count_ngrams(create_ngrams(file_to_list(AUSTEN), size)))
+            self.assertLess(gain * _peak_bytes(count_word_stream, AUSTEN, size), baseline)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('corpus', type=str, help='text file of corpus')
     parser.add_argument('-n', type=int, default=3, help='integer for the amount of words in sequence ')
     parser.add_argument('-m', type=int, default=10, help='integer for the amount of top frequencies')
+    parser.add_argument('-max_ngrams', type=int, help='maximum number of distinct ngrams kept in memory while '
+                                                      'counting, the rest is spilled to disk')
+    parser.add_argument('-workers', '--workers', type=int, default=1, help='number of processes used for counting')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.enable_from_args(args)
 
-    list_of_words = file_to_list(args.corpus)
-    ngrams = create_ngrams(list_of_words, args.n)
-    counted_ngrams = count_ngrams(ngrams)
-    mostcommon_ngrams = counted_ngrams.most_common(args.m)
+    with instrument.stage('count'):
+        counted_ngrams = count_word_stream(args.corpus, args.n, args.max_ngrams, args.workers)
+    instrument.count('ngram_tokens', counted_ngrams.total())
+    instrument.count('ngrams', len(counted_ngrams))
+    with instrument.stage('report'):
+        mostcommon_ngrams = counted_ngrams.most_common(args.m)
     pprint(mostcommon_ngrams)
 
-    print('The sum of the frequencies is: {0}'.format(sum(counted_ngrams.values())))
+    print('The sum of the frequencies is: {0}'.format(counted_ngrams.total()))
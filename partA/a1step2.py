@@ -3,12 +3,25 @@
 # Names: Yorick de Boer, Julian Main, Amor Frans
 
 import argparse
+import heapq
 import itertools
+import math
 import re
-from collections import Counter
 from pprint import pprint
 
+import numpy as np
+
+import instrument
+from a1step1 import NgramTable
+from a1step1 import Vocabulary
+from a1step1 import count_sentences
 from a1step1 import create_ngrams
+from modelfile import arrays_to_strings
+from modelfile import load_arrays
+from modelfile import save_arrays
+from modelfile import strings_to_arrays
+
+READ_BUFFER_SIZE = 1 << 20
 
 
 def insert_start_stop(corpus_filename):
@@ -36,6 +49,24 @@ def extract_sentences(text_start_stop):
     return sentences
 
 
+def read_sentences(corpus_filename, buffer_size=READ_BUFFER_SIZE):
+    """Lazily reads a text file and yields its paragraphs as sentences. Paragraphs are separated by empty lines.
+    Like extract_sentences every sentence is a list of words including the start and stop symbols."""
+    with open(corpus_filename, 'r', buffering=buffer_size) as corpus_txt:
+        sentence = ['0START0']
+        for line in corpus_txt:
+            if line == '\n':
+                if len(sentence) > 1:
+                    sentence.append('0STOP0')
+                    yield sentence
+                    sentence = ['0START0']
+            else:
+                sentence.extend(line.split())
+        if len(sentence) > 1:
+            sentence.append('0STOP0')
+            yield sentence
+
+
 def create_ngrams_all_sentences(sentences, sequence_size):
     """Creates ngrams for all sentences separately and appends them to one flattened list"""
     ngrams = [create_ngrams(sentence, sequence_size) for sentence in sentences]
@@ -68,55 +99,143 @@ def conditional_probability(ngram_count, ngram_1_count, ngram_test):
     return prob
 
 
-def file_condition_probability(ngrams, ngrams_1, cond_file):
+class NgramModel:
+    """Ngram counts of all orders 1..n, counted in one pass over the sentences of a corpus. The tables of all
+    orders share one vocabulary and key radix. The table of order 0 holds the count of the empty ngram, which
+    is the total number of words."""
+
+    def __init__(self, tables):
+        self.order = len(tables)
+        self.vocabulary = tables[0].vocabulary
+        self.radix = tables[0].radix
+        self.total = tables[0].total()
+        empty_table = NgramTable(self.vocabulary, 0, np.zeros(1, dtype=np.int64),
+                                 np.array([self.total], dtype=np.int64), self.radix)
+        self.tables = [empty_table] + list(tables)
+
+    @classmethod
+    def from_sentences(cls, sentences, order, max_entries=None, workers=1):
+        return cls(count_sentences(sentences, range(1, order + 1), max_entries=max_entries, workers=workers))
+
+    def save(self, path):
+        """Writes the vocabulary and the count tables of all orders to a model file"""
+        vocabulary_blob, vocabulary_offsets = strings_to_arrays(self.vocabulary.words)
+        arrays = {'vocabulary': vocabulary_blob, 'vocabulary_offsets': vocabulary_offsets}
+        for table in self.tables[1:]:
+            arrays['keys{0}'.format(table.sequence_size)] = table.key_array
+            arrays['counts{0}'.format(table.sequence_size)] = table.value_array
+        save_arrays(path, 'ngram', arrays, {'order': self.order, 'radix': self.radix})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Reads a model written by save, the count tables are memory-mapped from the file"""
+        meta, arrays = load_arrays(path, 'ngram', mmap)
+        vocabulary = Vocabulary(arrays_to_strings(arrays['vocabulary'], arrays['vocabulary_offsets']))
+        tables = [NgramTable(vocabulary, size, arrays['keys{0}'.format(size)], arrays['counts{0}'.format(size)],
+                             meta['radix'])
+                  for size in range(1, meta['order'] + 1)]
+        return cls(tables)
+
+    def counts(self, sequence_size):
+        """Returns the NgramTable of one order"""
+        return self.tables[sequence_size]
+
+    def count(self, ngram):
+        if len(ngram) > self.order:
+            return 0
+        return self.tables[len(ngram)].get(ngram, 0)
+
+    def conditional_probability(self, ngram):
+        """Returns P(last word | previous words), the history is cut to the order of the model"""
+        ngram = tuple(ngram[-self.order:])
+        count_n = self.count(ngram)
+        if not count_n:
+            return 0
+        return count_n / self.count(ngram[:-1])
+
+    def sequence_probability(self, words):
+        """Returns the probability of a sequence of words as the product of the conditional probability of every
+        word given at most order - 1 previous words"""
+        prob = 1
+        for idx in range(len(words)):
+            prob *= self.conditional_probability(words[max(0, idx - self.order + 1):idx + 1])
+            if prob == 0:
+                break
+        return prob
+
+
+def file_condition_probability(model, cond_file):
     """Returns the conditional probability of a sequence of words from a file"""
-    ngram_count = dict(Counter(ngrams))
-    ngram_1_count = dict(Counter(ngrams_1))
     probabilities = {}
-    cond_file_txt = open(cond_file, 'r')
-    for line in cond_file_txt:
-        n_gram_test = line.split()
-        prob = conditional_probability(ngram_count, ngram_1_count, n_gram_test)
-        probabilities['P(' + str(n_gram_test[-1:]) + '|' + str(n_gram_test[:-1]) + ')'] = prob
+    with open(cond_file, 'r') as cond_file_txt:
+        for line in cond_file_txt:
+            n_gram_test = line.split()
+            prob = model.conditional_probability(n_gram_test)
+            probabilities['P(' + str(n_gram_test[-1:]) + '|' + str(n_gram_test[:-1]) + ')'] = prob
     return probabilities
 
 
-def sequence_probability(corpus_start_stop, seq_file):
-    """Returns the probability of a sentence based on a ngram model"""
+def sequence_probability(model, seq_file):
+    """Returns the probability of every sentence in a file based on a ngram model"""
     all_probs = {}
-    seq_file_txt = open(seq_file, 'r')
-    for line in seq_file_txt:
-        list_of_line = line.split()  # Split every sentence into a list
-        grams_file = [list_of_line[:-idx] for idx, word in enumerate(list_of_line)]  # Creates list with sentences of
-        #  n-1 words
-        probabilities = []
-        for grams in grams_file:
-            length_of_string = len(grams)
-
-            #  Gets n grams based on the length of the current n-1 sentence
-            ngrams = create_ngrams(corpus_start_stop, length_of_string)
-            ngrams_1 = create_ngrams(corpus_start_stop, length_of_string - 1)
-            ngrams_counted = dict(Counter(ngrams))
-            ngrams_1_counted = dict(Counter(ngrams_1))
-
-            #  Create tuples from the sequence of words because that is how the counted ngrams are stored.
-            n_tuple = tuple(grams)
-            n_1_list = grams[:-1]
-            n_1_tuple = tuple(n_1_list)
-
-            #  Find the count of the ngrams
-            count_n = ngrams_counted.get(n_tuple)
-            count_1_n = ngrams_1_counted.get(n_1_tuple)
-            if count_n and count_1_n:
-                prob = count_n / count_1_n
-                probabilities.append(prob)
-        all_probs[line] = product_list(probabilities)
+    with open(seq_file, 'r') as seq_file_txt:
+        for line in seq_file_txt:
+            all_probs[line] = model.sequence_probability(line.split())
     return all_probs
 
 
-def scored_permutations(text_start_stop, words):
+def scored_permutations(model, words):
     permutations = itertools.permutations(words)
-    return sequence_probability(text_start_stop, permutations)
+    return {' '.join(permutation): model.sequence_probability(permutation) for permutation in permutations}
+
+
+def best_orderings(model, words, k=10, beam_width=100, start_stop=True):
+    """Searches the k most probable orderings of a bag of words without enumerating all permutations.
+
+    Partial orderings are extended word by word in a beam search. Two partial orderings with the same last
+    n-1 words and the same remaining words are scored the same from there on, so they are recombined into one
+    state that keeps its k best prefixes. Only the beam_width best states survive every step. With start_stop
+    the orderings are scored as sentences between the START and STOP symbol.
+    :return: [(ordering, probability), ...] best first
+    """
+    history_size = model.order - 1
+    vocab = sorted(set(words))
+    remaining = tuple(words.count(word) for word in vocab)
+    start = ('0START0',) if start_stop and history_size else ()
+
+    log_probs = {}
+
+    def log_probability(history, word):
+        ngram = history + (word,)
+        if ngram not in log_probs:
+            prob = model.conditional_probability(ngram)
+            log_probs[ngram] = math.log(prob) if prob > 0 else -math.inf
+        return log_probs[ngram]
+
+    beam = {(start, remaining): [(0.0, ())]}
+    for _ in range(len(words)):
+        expanded = {}
+        for (history, remaining), prefixes in beam.items():
+            for idx, count in enumerate(remaining):
+                if not count:
+                    continue
+                word = vocab[idx]
+                step = log_probability(history, word)
+                new_history = (history + (word,))[-history_size:] if history_size else ()
+                state = (new_history, remaining[:idx] + (count - 1,) + remaining[idx + 1:])
+                expanded.setdefault(state, []).extend(
+                    (score + step, prefix + (word,)) for score, prefix in prefixes)
+
+        beam = {state: heapq.nlargest(k, prefixes) for state, prefixes in expanded.items()}
+        if len(beam) > beam_width:
+            best_states = heapq.nlargest(beam_width, beam, key=lambda state: beam[state][0][0])
+            beam = {state: beam[state] for state in best_states}
+
+    orderings = []
+    for (history, _), prefixes in beam.items():
+        stop = log_probability(history, '0STOP0') if start_stop else 0.0
+        orderings.extend((score + stop, prefix) for score, prefix in prefixes)
+    return [(' '.join(ordering), math.exp(score)) for score, ordering in heapq.nlargest(k, orderings)]
 
 
 if __name__ == "__main__":
@@ -126,21 +245,34 @@ if __name__ == "__main__":
     parser.add_argument('-conditional_prob_file', type=str, help='conditional probability file')
     parser.add_argument('-sequence_prob_file', type=str, help='sequential probability file')
     parser.add_argument('-scored_permutations', type=str, help='set of words as list')
+    parser.add_argument('-top_k', type=int, default=10, help='number of best orderings of the scored permutations')
+    parser.add_argument('-beam_width', type=int, default=100, help='beam width of the ordering search')
+    parser.add_argument('-max_ngrams', type=int, help='maximum number of distinct ngrams kept in memory while '
+                                                      'counting, the rest is spilled to disk')
+    parser.add_argument('-workers', '--workers', type=int, default=1, help='number of processes used for counting')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.enable_from_args(args)
 
-    text_start_stop = insert_start_stop(args.corpus)
-    extracted_sentences = extract_sentences(text_start_stop)
-    ngrams_all_sentences = create_ngrams_all_sentences(extracted_sentences, args.n)
-    ngrams_1_all_sentences = create_ngrams_all_sentences(extracted_sentences, args.n - 1)
+    with instrument.stage('count'):
+        model = NgramModel.from_sentences(read_sentences(args.corpus), args.n, max_entries=args.max_ngrams,
+                                          workers=args.workers)
+    instrument.count('ngrams', len(model.counts(args.n)))
 
     print('\n')
     if args.conditional_prob_file:
         print('Conditional probability:')
-        pprint(file_condition_probability(ngrams_all_sentences, ngrams_1_all_sentences, args.conditional_prob_file))
+        with instrument.stage('conditional_probability'):
+            probabilities = file_condition_probability(model, args.conditional_prob_file)
+        pprint(probabilities)
     if args.sequence_prob_file:
         print('Sequential probability')
-        pprint(sequence_probability(text_start_stop, args.sequence_prob_file))
+        with instrument.stage('sequence_probability'):
+            probabilities = sequence_probability(model, args.sequence_prob_file)
+        pprint(probabilities)
     if args.scored_permutations:
         print('Scored permutations')
         print(args.scored_permutations)
-        scored_permutations(text_start_stop, args.scored_permutations)
+        with instrument.stage('orderings'):
+            orderings = best_orderings(model, args.scored_permutations.split(), args.top_k, args.beam_width)
+        pprint(orderings)
@@ -1,13 +1,19 @@
+import abc
 import argparse
+import functools
 import itertools
+from array import array
 from collections import Counter
 from pprint import pprint
 
+import numpy as np
+
+import instrument
+from a1step1 import NgramTable
 from a1step1 import create_ngrams
+from a1step2 import NgramModel
 from a1step2 import conditional_probability
-from a1step2 import create_ngrams_all_sentences
-from a1step2 import extract_sentences
-from a1step2 import insert_start_stop
+from a1step2 import read_sentences
 
 
 def get_all_possible_ngram_count(list_sentences, n):
@@ -43,6 +49,65 @@ def sequential_add_one_smoothing(ngram_count, n_1_gram_count, test_sentences, se
     return probabilities
 
 
+def sentence_windows(vocabulary, sentences, sequence_size):
+    """Encodes sentences to vocabulary ids, -1 for unknown words, and cuts them into ngrams like create_ngrams.
+    :return: 2d array with the ids of one ngram per row, array with the index of the sentence of every ngram
+    """
+    ids = array('q')
+    lengths = array('q')
+    for sentence in sentences:
+        ids.extend(vocabulary.lookup(sentence))
+        lengths.append(len(sentence))
+    ids = np.frombuffer(ids, dtype=np.int64)
+    sentence_idx = np.repeat(np.arange(len(lengths)), np.frombuffer(lengths, dtype=np.int64))
+
+    num_windows = len(ids) - sequence_size + 1
+    if num_windows <= 0:
+        return np.empty((0, sequence_size), dtype=np.int64), np.empty(0, dtype=np.int64)
+    starts = np.flatnonzero(sentence_idx[:num_windows] == sentence_idx[sequence_size - 1:])
+    windows = ids[starts[:, None] + np.arange(sequence_size)]
+    return windows, sentence_idx[starts]
+
+
+def batch_log_probabilities(ngram_count, n_1_gram_count, test_sentences, sequence_size, smoothing='no',
+                            voc_size=None, k=5, smoother=None):
+    """Scores all test sentences at once in log space. The counts of all ngrams and their histories are looked up
+    as arrays, so there is one lookup per order instead of one per ngram, and long sentences do not underflow.
+    :param smoothing: no | add1 | gt | kn | katz, voc_size and k have the same meaning as in the sequential
+    functions, kn and katz need the BackoffSmoother to query
+    :return: natural log probability per sentence, cross entropy in bits per ngram, perplexity
+    """
+    windows, sentence_idx = sentence_windows(ngram_count.vocabulary, test_sentences, sequence_size)
+    counts = ngram_count.lookup_ids(windows).astype(np.float64)
+    history_counts = n_1_gram_count.lookup_ids(windows[:, :-1]).astype(np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if smoothing == 'no':
+            probs = np.where((counts > 0) & (history_counts > 0), counts / history_counts, 0)
+        elif smoothing == 'add1':
+            if sequence_size > 1:
+                voc_size = len(ngram_count)
+            probs = (counts + 1) / (history_counts + voc_size)
+        elif smoothing == 'gt':
+            smoother = GoodTuringSmoother(ngram_count, n_1_gram_count, voc_size, k)
+            unique_counts, inverse = np.unique(counts.astype(np.int64), return_inverse=True)
+            smoothed_counts = np.array([smoother.smoothed_count(c) for c in unique_counts.tolist()],
+                                       dtype=np.float64)[inverse]
+            probs = np.where(counts > 0, smoothed_counts / history_counts, smoothed_counts)
+        elif smoothing in ('kn', 'katz'):
+            probs = smoother.probabilities(windows)
+        else:
+            raise ValueError('Unknown smoothing {0}'.format(smoothing))
+        log_probs = np.log(probs)
+
+    sentence_log_probs = np.bincount(sentence_idx, weights=log_probs, minlength=len(test_sentences))
+    if len(log_probs):
+        cross_entropy = -log_probs.sum() / np.log(2) / len(log_probs)
+    else:
+        cross_entropy = 0.0
+    return sentence_log_probs, cross_entropy, 2 ** cross_entropy
+
+
 def conditional_add_one_smoothing(ngram_count, n_1_gram_count, ngram_test, voc_size):
     p_ngram_count = ngram_count.get(ngram_test)  # Returns non if not found
     if p_ngram_count is None:
@@ -62,55 +127,254 @@ def conditional_add_one_smoothing(ngram_count, n_1_gram_count, ngram_test, voc_s
 def sequential_good_turing_smoothing(ngram_count, ngram_1_count, test_sentences, sequence_size, voc_size, k):
     """Good turing smoothed probability of a whole sentence"""
     probabilities = []
-    nnc_counts = nc_counts(ngram_count)
-    smoothed_gt_ngrams = conditional_good_turing_smoothing(nnc_counts, ngram_count, ngram_1_count, voc_size, k)
+    smoother = GoodTuringSmoother(ngram_count, ngram_1_count, voc_size, k)
     for sentence in test_sentences:
         paragraph_ngrams = create_ngrams(sentence, sequence_size)
 
         prob = 1
         for p_ngram in paragraph_ngrams:
-            # P(x|y)
-            y = p_ngram[:-1]
-            x = p_ngram[-1]
-
-            nprob = smoothed_gt_ngrams.get((y, x))
-            if nprob is None:
-                nprob = smoothed_gt_ngrams.get(('', ''))
-            prob *= nprob
+            prob *= smoother.probability(p_ngram)  # P(x|y)
 
         probabilities.append(prob)
     return probabilities
 
 
-def conditional_good_turing_smoothing(ngram_counts, ngram_1_counts, voc_size, k):
-    """Gets the good turing smoothed count from one ngram"""
-    cond_probs = {}
-    nnc_counts = nc_counts(ngram_counts)
-
-    for ngram in ngram_counts:
-        cgt = good_turing_count(nnc_counts, ngram_counts, ngram, voc_size, k)
-        count_n_1_gram = ngram_1_counts.get(ngram[:-1])
-        cond_probs[ngram] = cgt / count_n_1_gram
+class LookupCache:
+    """Mixin for an LRU cache of get() and probability() per instance. The caches are left out when an instance
+    is pickled, for workers that are not forked, and made again when it is unpickled."""
+
+    def _cache_lookups(self, cache_size):
+        self.cache_size = cache_size
+        if cache_size:
+            self.get = functools.lru_cache(maxsize=cache_size)(self.get)
+            self.probability = functools.lru_cache(maxsize=cache_size)(self.probability)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('get', None)
+        state.pop('probability', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lookups(self.cache_size)
+
+
+class GoodTuringSmoother(LookupCache):
+    """Good Turing smoothed conditional probabilities P(x|y), answered on demand from the raw ngram counts.
+    The Nc counts and the table of smoothed counts r -> r* for r <= k are computed once; counts above k are
+    not smoothed. Like the dictionary of conditional_good_turing_smoothing, get() only knows seen ngrams,
+    probability() also answers unseen ngrams.
+
+    With a cache_size, get() and probability() keep an LRU cache of that many recent ngrams."""
+
+    def __init__(self, ngram_counts, ngram_1_counts, all_possible_ngramcount, k, cache_size=None):
+        self.ngram_counts = ngram_counts
+        self.ngram_1_counts = ngram_1_counts
+        self.k = k
+        self.nc = nc_counts(ngram_counts)
+        self.nc[0] = all_possible_ngramcount - sum(self.nc.values())
+        self.smoothed_counts = [smoothed_count(r, self.nc, k) for r in range(k + 1)]
+        self.unseen = self.smoothed_counts[0]
+        self._cache_lookups(cache_size)
+
+    def smoothed_count(self, r):
+        """Returns r* for a raw count r"""
+        if r <= self.k:
+            return self.smoothed_counts[r]
+        return r
 
-    # For not appearin ngrams
-    cgt = good_turing_count(nnc_counts, ngram_counts, (), voc_size, k)
-    cond_probs[('', '')] = cgt
-    return cond_probs
+    def get(self, ngram, default=None):
+        """Returns P(x|y) of a seen ngram (y, x), the default for unseen ngrams"""
+        c = self.ngram_counts.get(ngram)
+        if c is None:
+            return default
+        return self.smoothed_count(c) / self.ngram_1_counts.get(ngram[:-1])
+
+    def probability(self, ngram):
+        """Returns P(x|y) of an ngram (y, x), the smoothed count of unseen ngrams if it was not seen"""
+        return self.get(ngram, self.unseen)
+
+    def to_dict(self):
+        """Returns all conditional probabilities as one dictionary, with the unseen value under ('', '')"""
+        cond_probs = {ngram: self.get(ngram) for ngram in self.ngram_counts}
+        cond_probs[('', '')] = self.unseen
+        return cond_probs
+
+    def values(self):
+        return [self.get(ngram) for ngram in self.ngram_counts]
+
+    def __contains__(self, ngram):
+        return ngram in self.ngram_counts
+
+    def __iter__(self):
+        return iter(self.ngram_counts)
+
+    def __len__(self):
+        return len(self.ngram_counts)
+
+
+class BackoffSmoother(LookupCache, abc.ABC):
+    """Base of the Kneser-Ney and Katz backoff smoothers over an NgramModel of all orders 1..n.
+
+    Training precomputes two tables per order k: probs[k] holds the (discounted) probability term of every seen
+    k-gram and weights[k] the backoff weight of every seen history of k - 1 words. A query for P(w|h) then walks
+    up from a uniform distribution over the vocabulary plus one unknown word, doing two table lookups per order.
+    Interpolated smoothers add the lower order probability to every k-gram, backoff smoothers only use it for
+    k-grams that were not seen. Unseen histories have weight 1."""
+    interpolated = False
+
+    def __init__(self, model, cache_size=None):
+        self.model = model
+        self.order = model.order
+        self.radix = model.radix
+        self.base = 1 / (len(model.vocabulary) + 1)
+        self.probs = [None] * (self.order + 1)
+        self.weights = [None] * (self.order + 1)
+        self.train()
+        self._cache_lookups(cache_size)
+
+    @abc.abstractmethod
+    def train(self):
+        """Fills the probs and weights tables of every order with _set_order"""
+
+    def _set_order(self, sequence_size, keys, probs, history_keys, weights):
+        vocabulary = self.model.vocabulary
+        self.probs[sequence_size] = NgramTable(vocabulary, sequence_size, keys, probs, self.radix)
+        self.weights[sequence_size] = NgramTable(vocabulary, sequence_size - 1, history_keys, weights, self.radix)
+
+    def probability(self, ngram):
+        """Returns P(last word | previous words), the history is cut to the order of the model"""
+        ngram = tuple(ngram[-self.order:])
+        prob = self.base
+        for sequence_size in range(1, len(ngram) + 1):
+            gram = ngram[-sequence_size:]
+            seen = self.probs[sequence_size].get(gram)
+            weight = self.weights[sequence_size].get(gram[:-1], 1.0)
+            if self.interpolated:
+                prob = (seen or 0.0) + weight * prob
+            elif seen is not None:
+                prob = seen
+            else:
+                prob = weight * prob
+        return prob
+
+    def probabilities(self, ids):
+        """Vectorized probability for a 2d array with one ngram of vocabulary ids per row, -1 for unknown words"""
+        ids = np.asarray(ids)[:, -self.order:]
+        prob = np.full(len(ids), self.base)
+        for sequence_size in range(1, ids.shape[1] + 1):
+            grams = ids[:, -sequence_size:]
+            seen = self.probs[sequence_size].lookup_ids(grams, np.nan)
+            weight = self.weights[sequence_size].lookup_ids(grams[:, :-1], 1.0)
+            if self.interpolated:
+                prob = np.where(np.isnan(seen), 0.0, seen) + weight * prob
+            else:
+                prob = np.where(np.isnan(seen), weight * prob, seen)
+        return prob
+
+    def get(self, ngram, default=None):
+        """Like probability, smoothed models know every ngram so the default is never used"""
+        return self.probability(ngram)
+
+    def values(self):
+        return [self.get(ngram) for ngram in self]
+
+    def __iter__(self):
+        return iter(self.model.counts(self.order))
+
+    def __len__(self):
+        return len(self.model.counts(self.order))
+
+
+class KneserNeySmoother(BackoffSmoother):
+    """Interpolated Kneser-Ney smoothing with one absolute discount D = n1 / (n1 + 2 * n2) per order. The
+    highest order uses the ngram counts, lower orders use continuation counts: the number of distinct words
+    seen before an ngram."""
+    interpolated = True
+
+    def train(self):
+        for sequence_size in range(1, self.order + 1):
+            if sequence_size == self.order:
+                table = self.model.counts(sequence_size)
+                keys, counts = table.key_array, table.value_array
+            else:
+                upper_keys = self.model.counts(sequence_size + 1).key_array
+                keys, counts = np.unique(upper_keys % self.radix ** sequence_size, return_counts=True)
+            counts = counts.astype(np.float64)
+
+            n1 = np.count_nonzero(counts == 1)
+            n2 = np.count_nonzero(counts == 2)
+            discount = n1 / (n1 + 2 * n2) if n1 else 0.0
+
+            history_keys, inverse = np.unique(keys // self.radix, return_inverse=True)
+            denominators = np.bincount(inverse, weights=counts)
+            types = np.bincount(inverse)
+            probs = np.maximum(counts - discount, 0) / denominators[inverse]
+            self._set_order(sequence_size, keys, probs, history_keys, discount * types / denominators)
+
+
+class KatzBackoffSmoother(BackoffSmoother):
+    """Katz backoff smoothing. Seen ngrams get their relative frequency discounted by the Good Turing ratio
+    r* / r for counts up to k, the left over mass of every history is spread over the unseen words by the
+    backoff weight alpha(h) in proportion to their lower order probability."""
+
+    def __init__(self, model, k=5, cache_size=None):
+        self.k = k
+        super().__init__(model, cache_size)
+
+    def train(self):
+        for sequence_size in range(1, self.order + 1):
+            table = self.model.counts(sequence_size)
+            keys, counts = table.key_array, table.value_array
+
+            nc = nc_counts(table)
+            unique_counts, inverse = np.unique(counts, return_inverse=True)
+            ratios = np.array([smoothed_count(r, nc, self.k) / r for r in unique_counts.tolist()])
+            ratios[(ratios <= 0) | (ratios > 1)] = 1.0
+            history_counts = self.model.counts(sequence_size - 1).lookup_keys(keys // self.radix)
+            probs = ratios[inverse] * counts / history_counts
+
+            if sequence_size == 1:
+                lower_probs = np.full(len(keys), self.base)
+            else:
+                lower_probs = self.probs[sequence_size - 1].lookup_keys(keys % self.radix ** (sequence_size - 1))
+
+            history_keys, inverse = np.unique(keys // self.radix, return_inverse=True)
+            left_over = 1 - np.bincount(inverse, weights=probs)
+            lower_left_over = 1 - np.bincount(inverse, weights=lower_probs)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                alphas = np.where(lower_left_over > 1e-12, np.maximum(left_over, 0) / lower_left_over, 0.0)
+            self._set_order(sequence_size, keys, probs, history_keys, alphas)
+
+
+def sequential_backoff_smoothing(smoother, test_sentences, sequence_size):
+    """Kneser-Ney or Katz smoothed probability of every sentence"""
+    probabilities = []
+    for sentence in test_sentences:
+        prob = 1
+        for p_ngram in create_ngrams(sentence, sequence_size):
+            prob *= smoother.probability(p_ngram)
+        probabilities.append(prob)
+    return probabilities
 
 
-def good_turing_count(nc_counts, ngram_counts, one_ngram, all_possible_ngramcount, k):
-    """Gets the good turing smoothed count from one ngram"""
-    c = ngram_counts.get(one_ngram)
-    if c is None:
-        c = 0
-    nc_counts[0] = all_possible_ngramcount - sum(nc_counts.values())
-    return good_turing_function(c, nc_counts, k)
+def conditional_good_turing_smoothing(ngram_counts, ngram_1_counts, voc_size, k):
+    """Gets the good turing smoothed conditional probability of every ngram"""
+    return GoodTuringSmoother(ngram_counts, ngram_1_counts, voc_size, k).to_dict()
 
 
 def nc_counts(ngram_count):
     """Creates a list of Nc counts assumes no gaps"""
-    values = [ngram_count.get(key_bigram_count) for key_bigram_count in ngram_count]
-    return dict(Counter(values))
+    return dict(Counter(ngram_count.values()))
+
+
+def smoothed_count(r, n, k):
+    """Good Turing smoothed count, falls back to the raw count where a gap in the Nc counts makes it undefined"""
+    try:
+        return good_turing_function(r, n, k)
+    except (KeyError, ZeroDivisionError):
+        return r
 
 
 def good_turing_function(r, n, k):
@@ -126,30 +390,75 @@ def good_turing_function(r, n, k):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('training_corpus', type=str, help='text file of training corpus')
-    parser.add_argument('test_corpus', type=str, help='text file of test corpus')
+    parser.add_argument('corpora', type=str, nargs='+',
+                        help='text files of training corpus and test corpus, only the test corpus with -load_model')
     parser.add_argument('-n', type=int, help='value')
-    parser.add_argument('-smoothing', type=str, help='smoothing algorithm', default='no')
+    parser.add_argument('-smoothing', type=str, help='smoothing algorithm: no | add1 | gt | kn | katz', default='no')
+    parser.add_argument('-max_ngrams', type=int, help='maximum number of distinct ngrams kept in memory while '
+                                                      'counting, the rest is spilled to disk')
+    parser.add_argument('-workers', '--workers', type=int, default=1, help='number of processes used for counting')
+    parser.add_argument('-save_model', type=str, help='path to save the trained ngram model')
+    parser.add_argument('-load_model', type=str, help='path of a saved ngram model, replaces the training corpus')
+    parser.add_argument('-perplexity', action='store_true',
+                        help='print log probabilities of the test sentences, cross entropy and perplexity')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
-
-    corpus_start_stop = insert_start_stop(args.training_corpus)
-    corpus_extracted_sentences = extract_sentences(corpus_start_stop)
-
-    test_start_stop = insert_start_stop(args.test_corpus)
-    test_extracted_sentences = extract_sentences(test_start_stop)
-
-    corpus_ngrams_all_sentences = create_ngrams_all_sentences(corpus_extracted_sentences, args.n)
-    corpus_ngrams_1_all_sentences = create_ngrams_all_sentences(corpus_extracted_sentences, args.n - 1)
-    ngram_count = dict(Counter(corpus_ngrams_all_sentences))
-    n_1_gram_count = dict(Counter(corpus_ngrams_1_all_sentences))
-
-    all_possible_ngram_count = get_all_possible_ngram_count(test_extracted_sentences, args.n)
-
-    if args.smoothing == 'no':
-        pprint(sequential_no_smoothing(ngram_count, n_1_gram_count, test_extracted_sentences, args.n))
-    elif args.smoothing == 'add1':
-        pprint(sequential_add_one_smoothing(ngram_count, n_1_gram_count, test_extracted_sentences, args.n,
-                                            all_possible_ngram_count))
-    elif args.smoothing == 'gt':
-        pprint(sequential_good_turing_smoothing(ngram_count, n_1_gram_count, test_extracted_sentences, args.n,
-                                                all_possible_ngram_count, 5))
+    instrument.enable_from_args(args)
+
+    if args.load_model:
+        with instrument.stage('load'):
+            model = NgramModel.load(args.load_model)
+        if args.n is None:
+            args.n = model.order
+        elif args.n > model.order:
+            parser.error('-n {0} is larger than the order {1} of the saved model'.format(args.n, model.order))
+    elif len(args.corpora) == 2:
+        with instrument.stage('count'):
+            model = NgramModel.from_sentences(read_sentences(args.corpora[0]), args.n,
+                                              max_entries=args.max_ngrams, workers=args.workers)
+    else:
+        parser.error('a training corpus and a test corpus are required without -load_model')
+    if args.save_model:
+        with instrument.stage('save'):
+            model.save(args.save_model)
+
+    with instrument.stage('read_test'):
+        test_extracted_sentences = list(read_sentences(args.corpora[-1]))
+    instrument.count('sentences', len(test_extracted_sentences))
+    instrument.count('tokens', sum(len(sentence) for sentence in test_extracted_sentences))
+    ngram_count = model.counts(args.n)
+    n_1_gram_count = model.counts(args.n - 1)
+    instrument.count('ngrams', len(ngram_count))
+
+    with instrument.stage('smooth'):
+        all_possible_ngram_count = get_all_possible_ngram_count(test_extracted_sentences, args.n)
+
+        smoother = None
+        if args.smoothing == 'kn':
+            smoother = KneserNeySmoother(model)
+        elif args.smoothing == 'katz':
+            smoother = KatzBackoffSmoother(model, 5)
+
+    with instrument.stage('score'):
+        if args.perplexity:
+            log_probs, cross_entropy, perplexity = batch_log_probabilities(ngram_count, n_1_gram_count,
+                                                                           test_extracted_sentences, args.n,
+                                                                           args.smoothing, all_possible_ngram_count,
+                                                                           5, smoother)
+            result = log_probs.tolist()
+        elif args.smoothing == 'no':
+            result = sequential_no_smoothing(ngram_count, n_1_gram_count, test_extracted_sentences, args.n)
+        elif args.smoothing == 'add1':
+            result = sequential_add_one_smoothing(ngram_count, n_1_gram_count, test_extracted_sentences, args.n,
+                                                  all_possible_ngram_count)
+        elif args.smoothing == 'gt':
+            result = sequential_good_turing_smoothing(ngram_count, n_1_gram_count, test_extracted_sentences, args.n,
+                                                      all_possible_ngram_count, 5)
+        elif smoother is not None:
+            result = sequential_backoff_smoothing(smoother, test_extracted_sentences, args.n)
+        else:
+            result = None
+    if result is not None:
+        pprint(result)
+    if args.perplexity:
+        print('Cross entropy: {0} bits, perplexity: {1}'.format(cross_entropy, perplexity))
@@ -1,12 +1,71 @@
 import argparse
 import gzip
+import io
 import itertools
+import multiprocessing
+import os
+import pickle
 import re
+import tempfile
+import time
+import unittest
+from array import array
 from collections import Counter
 
-from a1step2 import create_ngrams_all_sentences
-from a1step3 import conditional_good_turing_smoothing
+import numpy as np
+
+import instrument
+from a1step1 import NgramTable
+from a1step1 import Vocabulary
+from a1step1 import ordered_imap
+from a1step2 import NgramModel
+from a1step3 import GoodTuringSmoother
+from a1step3 import KatzBackoffSmoother
+from a1step3 import KneserNeySmoother
 from a1step3 import get_all_possible_ngram_count
+from modelfile import arrays_to_strings
+from modelfile import load_arrays
+from modelfile import save_arrays
+from modelfile import strings_to_arrays
+
+MODEL_CACHE_SIZE = 1 << 16
+TAG_CHUNK_SIZE = 256
+PRUNING_COUNTERS = ('cells_total', 'cells_scored', 'transitions_total', 'transitions_scored')
+
+
+# One whitespace separated token per match: a sentence boundary, or a word/TAG pair of letters, dashes and quotes
+# that does not contain ``
+POS_TOKEN = re.compile(r"(?<!\S)(?:(={38}|\./\.)|(?!\S*``)((?:[a-zA-z]|-|')+)/([a-zA-z]+))(?!\S)")
+READ_BUFFER_SIZE = 1 << 20
+
+
+def read_pos_sentences(file_stream, words, tags, buffer_size=READ_BUFFER_SIZE):
+    """Streaming parser for a POS file, yields one sentence at a time as a list of (word id, tag id) pairs.
+    The stream is decoded in large blocks that are cut at the last new line and scanned with one regex.
+    :param file_stream: binary file stream, like gzip.open(path, 'rb')
+    :param words: Vocabulary the words are interned in
+    :param tags: Vocabulary the POS tags are interned in
+    """
+    text_stream = io.TextIOWrapper(file_stream, encoding='utf-8')
+    add_word = words.add
+    add_tag = tags.add
+    sentence = []
+    remainder = ''
+    while True:
+        chunk = text_stream.read(buffer_size)
+        text = remainder + chunk
+        cut = len(text) if not chunk else text.rfind('\n') + 1
+        remainder = text[cut:]
+        for boundary, word, tag in POS_TOKEN.findall(text, 0, cut):
+            if boundary:
+                if sentence:
+                    yield sentence
+                    sentence = []
+            else:
+                sentence.append((add_word(word), add_tag(tag)))
+        if not chunk:
+            break
+    text_stream.detach()
 
 
 def parse_pos_file(file_stream):
@@ -14,21 +73,51 @@ def parse_pos_file(file_stream):
     :param file_stream file stream
     :return: [[['No', 'RB'], ['it', 'PRP'], ['was', 'VBD'],.....
     """
+    words = Vocabulary()
+    tags = Vocabulary()
+    return [[[words[word_id], tags[tag_id]] for word_id, tag_id in sentence]
+            for sentence in read_pos_sentences(file_stream, words, tags)]
+
+
+def _read_pos_path(path):
+    """Parses one gzipped POS file in a worker, returns its vocabularies and the sentences as flat id arrays"""
+    words = Vocabulary()
+    tags = Vocabulary()
+    word_ids = array('i')
+    tag_ids = array('i')
+    lengths = array('i')
+    with gzip.open(path, 'rb') as f:
+        for sentence in read_pos_sentences(f, words, tags):
+            for word_id, tag_id in sentence:
+                word_ids.append(word_id)
+                tag_ids.append(tag_id)
+            lengths.append(len(sentence))
+    return words.words, tags.words, word_ids, tag_ids, lengths
+
+
+def read_pos_files(paths, workers=1):
+    """Parses several gzipped POS files, like the WSJ sections, into one list of sentences in the format of
+    parse_pos_file. With more than one worker the files are decompressed and parsed in parallel."""
+    if workers <= 1 or len(paths) <= 1:
+        sentences = []
+        for path in paths:
+            with gzip.open(path, 'rb') as f:
+                sentences.extend(parse_pos_file(f))
+        return sentences
+
+    words = Vocabulary()
+    tags = Vocabulary()
     sentences = []
-    sentence = []
-    for line in file_stream.readlines():
-        dline = line.decode("utf-8")
-        dline_split = dline.split()
-        for word in dline_split:
-            if re.fullmatch('.*``.*', word):
-                continue
-            if re.fullmatch('([a-zA-z]|-|\')+/[a-zA-z]+', word):
-                word_tag = word.split('/')
-                sentence.append(word_tag)
-            if word == '======================================' or word == './.':
-                if sentence:
-                    sentences.append(sentence)
-                    sentence = []
+    with multiprocessing.Pool(min(workers, len(paths))) as pool:
+        for file_words, file_tags, word_ids, tag_ids, lengths in pool.imap(_read_pos_path, paths):
+            # Map the ids of the file onto the shared strings, so equal words are one object in memory
+            file_words = [words[words.add(word)] for word in file_words]
+            file_tags = [tags[tags.add(tag)] for tag in file_tags]
+            start = 0
+            for length in lengths:
+                sentences.append([[file_words[word_ids[idx]], file_tags[tag_ids[idx]]]
+                                  for idx in range(start, start + length)])
+                start += length
     return sentences
 
 
@@ -70,44 +159,58 @@ def insert_start_stop_list(sentences):
     return sentences
 
 
-def transition_model(word_pos_sentences, k, smoothing='yes'):
+def transition_model(word_pos_sentences, k, smoothing='yes', order=2):
     """
     Transition and emission model
     :param word_pos_sentences
     :param k: c < k
-    :param smoothing: yes | no
+    :param smoothing: yes (Good Turing) | no | kn (Kneser-Ney) | katz
+    :param order: 2 for P(tag | previous tag), 3 for P(tag | two previous tags) which needs kn or katz smoothing.
+    Sentences of order 3 start with two start symbols, so the first tag has the trigram P(tag | 0START0, 0START0)
+    instead of the lower order Kneser-Ney distribution, whose continuation counts are empty after 0START0
     :return:
     """
     sentences_word_pos = extract_pos_sentences(word_pos_sentences)
     start_stop_sentences_pos = insert_start_stop_list(sentences_word_pos)
+    if order == 3:
+        for sentence in start_stop_sentences_pos:
+            sentence.insert(0, '0START0')
+
+    if smoothing == 'kn':
+        return KneserNeySmoother(NgramModel.from_sentences(start_stop_sentences_pos, order),
+                                 cache_size=MODEL_CACHE_SIZE)
+    elif smoothing == 'katz':
+        return KatzBackoffSmoother(NgramModel.from_sentences(start_stop_sentences_pos, order), k,
+                                   cache_size=MODEL_CACHE_SIZE)
+    elif order != 2:
+        raise ValueError('A transition model of order {0} needs kn or katz smoothing'.format(order))
 
     voc_size = get_all_possible_ngram_count(start_stop_sentences_pos, 2)
 
-    trainset_ngrams_all_sentences = create_ngrams_all_sentences(start_stop_sentences_pos, 2)
-    trainset_ngrams_1_all_sentences = create_ngrams_all_sentences(start_stop_sentences_pos, 2 - 1)
-
-    ngram_count = dict(Counter(trainset_ngrams_all_sentences))  # {('RBR', 'IN'): 23, ('JJS', 'CD'): 5,...
-    n_1_gram_count = dict(Counter(trainset_ngrams_1_all_sentences))  # {('NNS',): 3458, ('JJR',): 193, ('VBN',): 1096,.
+    ngram_count = NgramTable.from_sentences(start_stop_sentences_pos, 2)  # {('RBR', 'IN'): 23, ('JJS', 'CD'): 5,...
+    n_1_gram_count = NgramTable.from_sentences(start_stop_sentences_pos, 2 - 1,
+                                               ngram_count.vocabulary)  # {('NNS',): 3458, ('JJR',): 193,...
 
     if smoothing == 'yes':
-        return conditional_good_turing_smoothing(ngram_count, n_1_gram_count, voc_size, k)
+        return GoodTuringSmoother(ngram_count, n_1_gram_count, voc_size, k, cache_size=MODEL_CACHE_SIZE)
     else:
         return conditional_no_smoothing(ngram_count, n_1_gram_count)
 
 
 def emission_model(word_pos_sentences, k, smoothing='yes'):
     # Get count for (POSTAG, WORD)
+    # Every (POSTAG, WORD) tuple is counted as a sentence holding exactly one bigram
     only_word_pos = extract_word_pos(word_pos_sentences)
-    pos_word_count = dict(Counter(only_word_pos))
+    pos_word_count = NgramTable.from_sentences(only_word_pos, 2)
 
     # Get count for (POSTAG)
     only_pos = extract_pos(word_pos_sentences)
-    pos_count = dict(Counter(only_pos))
+    pos_count = NgramTable.from_sentences(only_pos, 1, pos_word_count.vocabulary)
 
-    if smoothing == 'yes':
-        return conditional_good_turing_smoothing(pos_word_count, pos_count, 1, k)
-    else:
+    if smoothing == 'no':
         return conditional_no_smoothing(pos_word_count, pos_count)
+    else:
+        return GoodTuringSmoother(pos_word_count, pos_count, 1, k, cache_size=MODEL_CACHE_SIZE)
 
 
 def conditional_no_smoothing(ngram_count, ngram_1_count):
@@ -119,6 +222,46 @@ def conditional_no_smoothing(ngram_count, ngram_1_count):
     return cond_probs
 
 
+def dense_transitions(trans_model):
+    """Returns the probabilities of all transitions between the tags of a bigram transition model, from the start
+    symbol and to the stop symbol, as a dictionary. Smoothed models give unseen transitions a probability that is
+    not in their tables of seen ngrams."""
+    states = sorted(set(itertools.chain(*trans_model)) - {'0START0', '0STOP0'})
+    transitions = {}
+    for previous in ['0START0'] + states:
+        for state in states + ['0STOP0']:
+            prob = trans_model.get((previous, state))
+            if prob is not None:
+                transitions[previous, state] = prob
+    return transitions
+
+
+def save_hmm(path, trans_model, emiss_model):
+    """Writes the transition and emission probability tables to a model file, both share one vocabulary.
+    The transitions are written for every pair of tags, so the smoothed probabilities of unseen ones are kept."""
+    vocabulary = Vocabulary()
+    trans_table = NgramTable.from_mapping(dense_transitions(trans_model), vocabulary)
+    emiss_table = NgramTable.from_mapping(emiss_model, vocabulary)
+    vocabulary_blob, vocabulary_offsets = strings_to_arrays(vocabulary.words)
+    arrays = {'vocabulary': vocabulary_blob, 'vocabulary_offsets': vocabulary_offsets,
+              'transition_keys': trans_table.key_array, 'transition_probs': trans_table.value_array,
+              'emission_keys': emiss_table.key_array, 'emission_probs': emiss_table.value_array}
+    meta = {'transition_size': trans_table.sequence_size, 'transition_radix': trans_table.radix,
+            'emission_size': emiss_table.sequence_size, 'emission_radix': emiss_table.radix}
+    save_arrays(path, 'hmm', arrays, meta)
+
+
+def load_hmm(path, mmap=True):
+    """Reads the transition and emission model written by save_hmm as memory-mapped NgramTables"""
+    meta, arrays = load_arrays(path, 'hmm', mmap)
+    vocabulary = Vocabulary(arrays_to_strings(arrays['vocabulary'], arrays['vocabulary_offsets']))
+    trans_model = NgramTable(vocabulary, meta['transition_size'], arrays['transition_keys'],
+                             arrays['transition_probs'], meta['transition_radix'])
+    emiss_model = NgramTable(vocabulary, meta['emission_size'], arrays['emission_keys'], arrays['emission_probs'],
+                             meta['emission_radix'])
+    return trans_model, emiss_model
+
+
 class viterbi:
     def __init__(self, trans_model, emiss_model):
         self.t_model = trans_model
@@ -197,6 +340,443 @@ class viterbi:
         return pos_sentence, maxprob
 
 
+def build_tag_dictionary(word_pos_sentences, rare_threshold=2):
+    """Collects the POS tags every word was seen with in the training sentences.
+    :return: {word: [tags]} for words seen at least rare_threshold times, [tags] seen with the rarer words which
+    are allowed for rare and unknown words
+    """
+    word_counts = Counter()
+    word_tags = {}
+    for sentence in word_pos_sentences:
+        for word, tag in sentence:
+            word_counts[word] += 1
+            word_tags.setdefault(word, set()).add(tag)
+    tag_dictionary = {word: sorted(tags) for word, tags in word_tags.items() if word_counts[word] >= rare_threshold}
+    open_tags = sorted({tag for word, tags in word_tags.items() if word_counts[word] < rare_threshold
+                        for tag in tags})
+    return tag_dictionary, open_tags
+
+
+class dense_viterbi:
+    """Viterbi decoder in log space over a lattice indexed by position, so repeated words get their own cells.
+    The transition model is compiled into a dense S x S matrix of log probabilities, plus vectors for the
+    transitions from the start and to the stop symbol, and the emission model into one row of log probabilities
+    over the states per word. Every position of a sentence is then one numpy max/argmax over the S x S scores.
+
+    The search can be pruned in two ways. With a tag dictionary from build_tag_dictionary only the tags a word
+    was seen with are considered for it. With a beam_width only that many best states of a position are extended,
+    with a beam_threshold only the states whose log probability is within the threshold of the best one. The
+    cells and transitions that were actually scored are counted for pruning_report."""
+
+    def __init__(self, trans_model, emiss_model, tag_dictionary=None, beam_width=None, beam_threshold=None):
+        self.t_model = trans_model
+        self.e_model = emiss_model
+        self.states = self.get_states()
+        self.state_ids = {state: idx for idx, state in enumerate(self.states)}
+        self.all_state_ids = np.arange(len(self.states))
+
+        self.log_trans = self._log(
+            [[trans_model.get((previous, state)) for state in self.states] for previous in self.states])
+        self.log_start = self._log([trans_model.get(('0START0', state)) for state in self.states])
+        self.log_stop = self._log([trans_model.get((state, '0STOP0')) for state in self.states])
+
+        emission_probs = {}
+        for ngram in emiss_model:
+            state, word = ngram
+            if state in self.state_ids:
+                emission_probs.setdefault(word, {})[self.state_ids[state]] = emiss_model.get(ngram)
+        self.word_ids = {word: idx for idx, word in enumerate(emission_probs)}
+        emissions = np.zeros((len(self.word_ids) + 1, len(self.states)))  # Last row is for unknown words
+        for word, probs in emission_probs.items():
+            emissions[self.word_ids[word], list(probs)] = list(probs.values())
+        self.log_emissions = self._log(emissions)
+
+        self.candidates = None
+        self.open_candidates = self.all_state_ids
+        if tag_dictionary is not None:
+            word_tags, open_tags = tag_dictionary
+            self.candidates = {word: self._state_array(tags) for word, tags in word_tags.items()}
+            self.open_candidates = self._state_array(open_tags)
+        self.beam_width = beam_width
+        self.beam_threshold = beam_threshold
+
+        self.cells_total = 0
+        self.cells_scored = 0
+        self.transitions_total = 0
+        self.transitions_scored = 0
+
+    def _state_array(self, tags):
+        return np.array(sorted(self.state_ids[tag] for tag in tags if tag in self.state_ids), dtype=np.intp)
+
+    def get_states(self):
+        """POS tags seen in the transition model, without the start and stop symbol"""
+        states = set(itertools.chain(*self.t_model)) - {'0START0', '0STOP0'}
+        return sorted(states)
+
+    @staticmethod
+    def _log(probs):
+        probs = np.array(probs, dtype=np.float64)
+        probs[~(probs > 0)] = 0  # None lookups, and negative Good Turing estimates of small models
+        with np.errstate(divide='ignore'):
+            return np.log(probs)
+
+    def emission_rows(self, words):
+        """Returns the T x S log emission probabilities of a sentence"""
+        unknown = len(self.word_ids)
+        return self.log_emissions[[self.word_ids.get(word, unknown) for word in words]]
+
+    def word_candidates(self, word):
+        """Returns the state ids that are considered for a word"""
+        if self.candidates is None:
+            return self.all_state_ids
+        return self.candidates.get(word, self.open_candidates)
+
+    def _prune(self, states, scores):
+        """Returns the states of a position that survive the beam"""
+        states = states[scores[states] > -np.inf]
+        if self.beam_threshold is not None and len(states):
+            states = states[scores[states] >= scores[states].max() - self.beam_threshold]
+        if self.beam_width is not None and len(states) > self.beam_width:
+            states = states[np.argpartition(-scores[states], self.beam_width - 1)[:self.beam_width]]
+        return states
+
+    def run(self, sentence):
+        """Tags a sentence that includes the start and stop symbol
+        :return: (list of POS tags, log probability) or None if every path has probability 0
+        """
+        words = sentence[1:-1]
+        if not words:
+            return [], 0.0
+        emissions = self.emission_rows(words)
+        num_states = len(self.states)
+        backpointers = np.zeros((len(words), num_states), dtype=np.intp)
+        self.cells_total += len(words) * num_states
+        self.transitions_total += (len(words) - 1) * num_states * num_states
+        pruned = self.candidates is not None or self.beam_width is not None or self.beam_threshold is not None
+
+        current = self.word_candidates(words[0])
+        scores = np.full(num_states, -np.inf)
+        scores[current] = self.log_start[current] + emissions[0, current]
+        self.cells_scored += len(current)
+        for position in range(1, len(words)):
+            if not pruned:
+                candidates = scores[:, None] + self.log_trans
+                best_previous = candidates.argmax(axis=0)
+                backpointers[position] = best_previous
+                scores = candidates[best_previous, self.all_state_ids] + emissions[position]
+                self.cells_scored += num_states
+                self.transitions_scored += num_states * num_states
+                continue
+
+            previous = self._prune(current, scores)
+            current = self.word_candidates(words[position])
+            if not len(previous) or not len(current):
+                return None
+            candidates = scores[previous, None] + self.log_trans[np.ix_(previous, current)]
+            best = candidates.argmax(axis=0)
+            backpointers[position, current] = previous[best]
+            scores = np.full(num_states, -np.inf)
+            scores[current] = candidates[best, np.arange(len(current))] + emissions[position, current]
+            self.cells_scored += len(current)
+            self.transitions_scored += len(previous) * len(current)
+        scores = scores + self.log_stop
+
+        state = int(scores.argmax())
+        log_prob = scores[state]
+        if log_prob == -np.inf:
+            return None
+        pos_ids = [state]
+        for position in range(len(words) - 1, 0, -1):
+            state = int(backpointers[position, state])
+            pos_ids.append(state)
+        return [self.states[state] for state in reversed(pos_ids)], float(log_prob)
+
+    def pruning_report(self):
+        """Returns the fraction of lattice cells and transitions that were not scored because of pruning"""
+        cells = 1 - self.cells_scored / self.cells_total if self.cells_total else 0.0
+        transitions = 1 - self.transitions_scored / self.transitions_total if self.transitions_total else 0.0
+        return {'cells_pruned': cells, 'transitions_pruned': transitions}
+
+
+class trigram_viterbi(dense_viterbi):
+    """Second order Viterbi decoder for a trigram transition model, a Kneser-Ney or Katz smoother of order 3.
+    The states are pairs of tags (t_i-1, t_i), the first tag of a sentence follows two start symbols.
+
+    Transitions are not stored as a dense S x S x S table. The smoother gives every unseen trigram
+    P(w|u,v) = weight(u,v) * P(w|v), so only the S x S backoff weights, the S x S bigram probabilities and the
+    probabilities of the observed tag trigrams are compiled. For every position the U x V x W scores are built from
+    the weights and bigrams, and the observed trigrams among the candidate tags are patched in. With a tag
+    dictionary U, V and W are the few tags of the words, which keeps decoding fast. Beams are not supported."""
+
+    def __init__(self, trans_model, emiss_model, tag_dictionary=None):
+        super().__init__(trans_model, emiss_model, tag_dictionary)
+        vocabulary = trans_model.model.vocabulary
+        num_states = len(self.states)
+        tag_ids = np.array(vocabulary.lookup(self.states), dtype=np.int64)
+        start, stop = vocabulary.lookup(['0START0', '0STOP0'])
+        pairs = np.stack(np.meshgrid(tag_ids, tag_ids, indexing='ij'), axis=-1).reshape(-1, 2)
+
+        self.log_start = self._log(trans_model.probabilities(
+            np.column_stack([np.full(num_states, start), np.full(num_states, start), tag_ids])))
+        self.log_start_pair = self._log(trans_model.probabilities(
+            np.column_stack([np.full(len(pairs), start), pairs]))).reshape(num_states, num_states)
+        self.log_stop_start = self._log(trans_model.probabilities(
+            np.column_stack([np.full(num_states, start), tag_ids, np.full(num_states, stop)])))
+        self.log_stop_pair = self._log(trans_model.probabilities(
+            np.column_stack([pairs, np.full(len(pairs), stop)]))).reshape(num_states, num_states)
+        self.log_backoff = self._log(trans_model.weights[3].lookup_ids(pairs, 1.0)).reshape(num_states, num_states)
+
+        state_of = np.full(len(vocabulary), -1, dtype=np.int64)
+        state_of[tag_ids] = np.arange(num_states)
+        trigrams = trans_model.probs[3].id_matrix()
+        trigrams = trigrams[(state_of[trigrams] >= 0).all(axis=1)]
+        self.trigram_states = state_of[trigrams]
+        self.log_trigrams = self._log(trans_model.probabilities(trigrams))
+
+    def transition_block(self, u_states, v_states, w_states):
+        """Returns the U x V x W log probabilities log P(w|u,v) of three sets of candidate states"""
+        block = (self.log_backoff[np.ix_(u_states, v_states)][:, :, None]
+                 + self.log_trans[np.ix_(v_states, w_states)][None, :, :])
+        positions = []
+        for states in (u_states, v_states, w_states):
+            position = np.full(len(self.states), -1, dtype=np.intp)
+            position[states] = np.arange(len(states))
+            positions.append(position)
+        u, v, w = (position[self.trigram_states[:, i]] for i, position in enumerate(positions))
+        observed = (u >= 0) & (v >= 0) & (w >= 0)
+        block[u[observed], v[observed], w[observed]] = self.log_trigrams[observed]
+        return block
+
+    def run(self, sentence):
+        """Tags a sentence that includes the start and stop symbol
+        :return: (list of POS tags, log probability) or None if every path has probability 0
+        """
+        words = sentence[1:-1]
+        if not words:
+            return [], 0.0
+        emissions = self.emission_rows(words)
+        candidates = [self.word_candidates(word) for word in words]
+        num_states = len(self.states)
+        self.cells_total += len(words) * num_states * num_states
+        self.transitions_total += (len(words) - 1) * num_states ** 3
+
+        # scores[i, j] is the best log probability of a path ending in the tags (candidates[t-1][i], candidates[t][j])
+        first = candidates[0]
+        scores = (self.log_start[first] + emissions[0, first])[None, :]
+        self.cells_scored += len(first)
+        backpointers = []
+        for position in range(1, len(words)):
+            previous, current = candidates[position - 1], candidates[position]
+            if position == 1:
+                block = self.log_start_pair[np.ix_(previous, current)][None, :, :]
+            else:
+                block = self.transition_block(candidates[position - 2], previous, current)
+            paths = scores[:, :, None] + block
+            best = paths.argmax(axis=0)
+            scores = np.take_along_axis(paths, best[None], axis=0)[0] + emissions[position, current][None, :]
+            backpointers.append(best)
+            self.cells_scored += scores.size
+            self.transitions_scored += paths.size
+
+        if len(words) == 1:
+            scores = scores + self.log_stop_start[first][None, :]
+        else:
+            scores = scores + self.log_stop_pair[np.ix_(candidates[-2], candidates[-1])]
+        i, j = np.unravel_index(int(scores.argmax()), scores.shape)
+        log_prob = scores[i, j]
+        if log_prob == -np.inf:
+            return None
+        pos_ids = [candidates[-1][j]]
+        for position in range(len(words) - 1, 0, -1):
+            pos_ids.append(candidates[position - 1][i])
+            if position > 1:
+                i, j = backpointers[position - 1][i, j], i
+        return [self.states[state] for state in reversed(pos_ids)], float(log_prob)
+
+
+# Tagger of the worker processes of tag_sentences, inherited from the parent when the pool forks
+_tagger = None
+
+
+def _set_tagger(tagger):
+    global _tagger
+    _tagger = tagger
+
+
+def _timed_run(tagger, sentence):
+    start = time.perf_counter()
+    tagged = tagger.run(sentence)
+    return tagged, time.perf_counter() - start
+
+
+def _tag_chunk(task):
+    """Tags a chunk of sentences in a worker, returns the results and the pruning counters they added"""
+    sentences, timed = task
+    before = [getattr(_tagger, name, 0) for name in PRUNING_COUNTERS]
+    if timed:
+        tagged = [_timed_run(_tagger, sentence) for sentence in sentences]
+    else:
+        tagged = [_tagger.run(sentence) for sentence in sentences]
+    return tagged, [getattr(_tagger, name, 0) - count for name, count in zip(PRUNING_COUNTERS, before)]
+
+
+def tag_sentences(tagger, sentences, workers=1, chunk_size=TAG_CHUNK_SIZE, timed=False):
+    """Yields tagger.run(sentence) for every sentence of an iterable, in input order. With timed it yields
+    (tagger.run(sentence), seconds) pairs with the decode time of every sentence.
+
+    With more than one worker the sentences are handed out in chunks of chunk_size to a process pool, and only a
+    few chunks per worker are in flight, so memory stays flat for any number of sentences. Where processes fork
+    the workers share the tagger of the parent read-only, otherwise it is sent once to every worker. The pruning
+    counters of the workers are added to the tagger of the parent."""
+    if workers <= 1:
+        for sentence in sentences:
+            yield _timed_run(tagger, sentence) if timed else tagger.run(sentence)
+        return
+
+    sentences = iter(sentences)
+    chunks = iter(lambda: (list(itertools.islice(sentences, chunk_size)), timed), ([], timed))
+    if 'fork' in multiprocessing.get_all_start_methods():
+        _set_tagger(tagger)
+        pool = multiprocessing.get_context('fork').Pool(workers)
+    else:
+        pool = multiprocessing.Pool(workers, _set_tagger, (tagger,))
+    try:
+        with pool:
+            for tagged, counts in ordered_imap(pool, _tag_chunk, chunks, 2 * workers):
+                for name, count in zip(PRUNING_COUNTERS, counts):
+                    if hasattr(tagger, name):
+                        setattr(tagger, name, getattr(tagger, name) + count)
+                yield from tagged
+    finally:
+        _set_tagger(None)
+
+
+class TaggingEvaluator:
+    """Incremental evaluation of a tagger, fed one (predicted, gold) sentence at a time with update so the
+    measures are available at any point of a run without keeping the predictions.
+
+    Keeps token accuracy, accuracy on words that were and were not seen in training, exact sentence matches, a
+    confusion matrix of gold tag x predicted tag, buckets of bucket_size sentence lengths and the decode time per
+    sentence. Sentences the tagger could not decode count all their tokens as wrong and are not in the confusion
+    matrix."""
+
+    def __init__(self, known_words=None, bucket_size=10):
+        self.known_words = known_words
+        self.bucket_size = bucket_size
+        self.tags = Vocabulary()
+        self.confusion = np.zeros((0, 0), dtype=np.int64)
+        self.sentences = 0
+        self.failed_sentences = 0
+        self.exact_sentences = 0
+        self.tokens = 0
+        self.correct_tokens = 0
+        self.unknown_tokens = 0
+        self.correct_unknown_tokens = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = {}  # first length of bucket: [sentences, tokens, correct tokens, exact sentences, seconds]
+
+    def _tag_ids(self, tags):
+        ids = self.tags.encode(tags)
+        if len(self.tags) > len(self.confusion):
+            size = max(len(self.tags), 2 * len(self.confusion))
+            confusion = np.zeros((size, size), dtype=np.int64)
+            confusion[:len(self.confusion), :len(self.confusion)] = self.confusion
+            self.confusion = confusion
+        return np.array(ids, dtype=np.intp)
+
+    def update(self, words, gold_tags, predicted_tags, seconds=0.0):
+        """Adds one sentence
+        :param words: the words of the sentence, without start and stop symbol
+        :param gold_tags: the correct POS tags
+        :param predicted_tags: the POS tags of the tagger, None if it could not decode the sentence
+        :param seconds: decode time of the sentence
+        """
+        length = len(gold_tags)
+        if self.known_words is None:
+            unknown = np.zeros(length, dtype=bool)
+        else:
+            unknown = np.array([word not in self.known_words for word in words], dtype=bool)
+        if predicted_tags is None:
+            correct = np.zeros(length, dtype=bool)
+            self.failed_sentences += 1
+        else:
+            gold_ids = self._tag_ids(gold_tags)
+            predicted_ids = self._tag_ids(predicted_tags)
+            np.add.at(self.confusion, (gold_ids, predicted_ids), 1)
+            correct = gold_ids == predicted_ids
+        num_correct = int(correct.sum())
+        exact = predicted_tags is not None and num_correct == length
+
+        self.sentences += 1
+        self.exact_sentences += exact
+        self.tokens += length
+        self.correct_tokens += num_correct
+        self.unknown_tokens += int(unknown.sum())
+        self.correct_unknown_tokens += int((correct & unknown).sum())
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        bucket = self.buckets.setdefault(length // self.bucket_size * self.bucket_size, [0, 0, 0, 0, 0.0])
+        bucket[0] += 1
+        bucket[1] += length
+        bucket[2] += num_correct
+        bucket[3] += exact
+        bucket[4] += seconds
+
+    @staticmethod
+    def _ratio(part, whole):
+        return part / whole if whole else 0.0
+
+    def token_accuracy(self):
+        return self._ratio(self.correct_tokens, self.tokens)
+
+    def known_accuracy(self):
+        return self._ratio(self.correct_tokens - self.correct_unknown_tokens, self.tokens - self.unknown_tokens)
+
+    def unknown_accuracy(self):
+        return self._ratio(self.correct_unknown_tokens, self.unknown_tokens)
+
+    def sentence_accuracy(self):
+        return self._ratio(self.exact_sentences, self.sentences)
+
+    def mean_seconds(self):
+        return self._ratio(self.seconds, self.sentences)
+
+    def confusion_matrix(self):
+        """Returns the tags and the matrix of counts with a row per gold tag and a column per predicted tag"""
+        return list(self.tags.words), self.confusion[:len(self.tags), :len(self.tags)].copy()
+
+    def most_confused(self, n=10):
+        """Returns the n most frequent (gold tag, predicted tag, count) errors"""
+        tags, confusion = self.confusion_matrix()
+        np.fill_diagonal(confusion, 0)
+        order = np.argsort(confusion, axis=None)[::-1][:n]
+        gold, predicted = np.unravel_index(order, confusion.shape)
+        return [(tags[g], tags[p], int(confusion[g, p])) for g, p in zip(gold, predicted) if confusion[g, p]]
+
+    def length_buckets(self):
+        """Returns (first length, sentences, token accuracy, sentence accuracy, mean seconds) per length bucket"""
+        return [(start, sentences, self._ratio(correct, tokens), self._ratio(exact, sentences),
+                 self._ratio(seconds, sentences))
+                for start, (sentences, tokens, correct, exact, seconds) in sorted(self.buckets.items())]
+
+    def report(self):
+        lines = ['Sentences {0} ({1} not decoded), tokens {2}'.format(self.sentences, self.failed_sentences,
+                                                                      self.tokens),
+                 'Token accuracy {0:.2%}, known words {1:.2%}, unknown words {2:.2%} ({3} tokens)'.format(
+                     self.token_accuracy(), self.known_accuracy(), self.unknown_accuracy(), self.unknown_tokens),
+                 'Sentence accuracy {0:.2%}'.format(self.sentence_accuracy()),
+                 'Decode time {0:.2f} ms per sentence, {1:.2f} ms max'.format(1000 * self.mean_seconds(),
+                                                                               1000 * self.max_seconds)]
+        for start, sentences, token_accuracy, sentence_accuracy, seconds in self.length_buckets():
+            lines.append('  length {0:>3}-{1:<3} {2:>6} sentences, tokens {3:.2%}, sentences {4:.2%}, '
+                         '{5:.2f} ms'.format(start, start + self.bucket_size - 1, sentences, token_accuracy,
+                                             sentence_accuracy, 1000 * seconds))
+        confused = ', '.join('{0}->{1} {2}'.format(*error) for error in self.most_confused(5))
+        lines.append('Most confused {0}'.format(confused))
+        return '\n'.join(lines)
+
+
 def calculate_accuracy(generated_pos_sentences, validation_pos_sentences):
     correct_count = 0
     total_not_none_count = 0
@@ -221,50 +801,167 @@ def percentage_dif(generated_pos_sentences, validation_pos_sentences):
     return sum(percentages_thesame) / len(percentages_thesame)
 
 
+def write_tagged_sentence(f, sentence, tagged):
+    """Writes a sentence and its generated POS tags in the format of save_lists_to_file"""
+    if tagged is not None and len(sentence) < 15:
+        f.write(' '.join(sentence) + '\n')
+        f.write(' '.join(tagged[0]) + '\n')
+        f.write('\n')
+
+
 def save_lists_to_file(filename, sentences1, sentences2):
-    f = open(filename, 'w')
-    for sentence1, sentence2 in zip(sentences1, sentences2):
-        if sentence2 is not None and len(sentence1) < 15:
-            f.write(' '.join(sentence1) + '\n')
-            f.write(' '.join(sentence2[0]) + '\n')
-            f.write('\n')
+    with open(filename, 'w') as f:
+        for sentence1, sentence2 in zip(sentences1, sentences2):
+            write_tagged_sentence(f, sentence1, sentence2)
+
+
+TRAIN_SET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raw', 'WSJ02-21.pos.gz')
+
+
+@unittest.skipUnless(os.path.exists(TRAIN_SET), 'needs the WSJ train set')
+class TestA1Step4(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with gzip.open(TRAIN_SET, 'rb') as f:
+            cls.word_pos_sentences = parse_pos_file(f)
+
+    def test_save_load(self):
+        # Every smoothed transition, seen or not, survives the model file
+        trans_model = transition_model(self.word_pos_sentences[:3000], 4, smoothing='kn')
+        emiss_model = emission_model(self.word_pos_sentences[:3000], 1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'hmm')
+            save_hmm(path, trans_model, emiss_model)
+            loaded_trans, loaded_emiss = load_hmm(path, mmap=False)
+        states = sorted(set(itertools.chain(*trans_model)) - {'0START0', '0STOP0'})
+        for previous, tag in itertools.product(['0START0'] + states, states + ['0STOP0']):
+            prob = trans_model.get((previous, tag))
+            self.assertGreater(prob, 0)
+            self.assertEqual(loaded_trans.get((previous, tag)), prob)
+        for ngram in emiss_model:
+            self.assertEqual(loaded_emiss.get(ngram), emiss_model.get(ngram))
+
+    def test_pickle(self):
+        # Workers that are not forked get the tagger pickled, with its smoothers and their caches
+        sentences = self.word_pos_sentences[:1000]
+        for smoothing in ('yes', 'kn'):
+            tagger = dense_viterbi(transition_model(sentences, 4, smoothing=smoothing), emission_model(sentences, 1))
+            loaded = pickle.loads(pickle.dumps(tagger))
+            sentence = ['0START0'] + [word for word, _ in sentences[0]] + ['0STOP0']
+            self.assertEqual(loaded.run(sentence), tagger.run(sentence))
+            self.assertEqual(loaded.t_model.get.cache_info().maxsize, MODEL_CACHE_SIZE)
+
+    def test_trigram_start(self):
+        # Most sentences start with a determiner, few with a past tense verb
+        trans_model = transition_model(self.word_pos_sentences, 4, smoothing='kn', order=3)
+        tagger = trigram_viterbi(trans_model, emission_model(self.word_pos_sentences[:100], 1))
+        start = dict(zip(tagger.states, np.exp(tagger.log_start)))
+        self.assertGreater(start['DT'], 10 * start['VBD'])
+        self.assertGreater(start['DT'], 0.15)
+
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-smoothing', type=str, help='yes|no', default='yes')
-    parser.add_argument('-train_set', type=str, help='path to train set')
+    parser.add_argument('-smoothing', type=str, help='yes|no|kn|katz, yes is Good Turing', default='yes')
+    parser.add_argument('-train_set', type=str, nargs='+', help='path(s) to train set files')
     parser.add_argument('-test_set', type=str, help='path to test set')
     parser.add_argument('-test_set_predicted', type=str, help='path to save the predicted pos sentences')
+    parser.add_argument('-save_model', type=str, help='path to save the trained transition and emission model')
+    parser.add_argument('-load_model', type=str, help='path of a saved model to use instead of the train set')
+    parser.add_argument('-workers', '--workers', type=int, default=1,
+                        help='number of processes to read train files and tag the test set')
+    parser.add_argument('-decoder', type=str, default='dense',
+                        help='dense (log space numpy decoder) | dict (original viterbi)')
+    parser.add_argument('-tag_dictionary', action='store_true',
+                        help='only consider the tags a word was seen with in the train set (dense decoder)')
+    parser.add_argument('-rare_threshold', type=int, default=2,
+                        help='words seen less often may get any tag seen with rare words')
+    parser.add_argument('-beam_width', type=int, help='number of best states extended per position (dense decoder)')
+    parser.add_argument('-beam_threshold', type=float,
+                        help='only extend states within this log probability of the best state (dense decoder)')
+    parser.add_argument('-hmm_order', type=int, default=2, choices=[2, 3],
+                        help='2 for a bigram HMM, 3 for a trigram HMM over tag pairs (needs -smoothing kn|katz)')
+    parser.add_argument('-report_every', type=int, help='print the evaluation every this many test sentences')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
-
-    with gzip.open(args.train_set, 'rb') as f:
-        word_pos_sentences = parse_pos_file(f)
-
-    with gzip.open(args.test_set, 'rb') as f:
-        word_pos_test_sentences = parse_pos_file(f)
+    instrument.enable_from_args(args)
 
     # CREATE MODELS
-    trans_model = transition_model(word_pos_sentences, 4, smoothing=args.smoothing)
-    emiss_model = emission_model(word_pos_sentences, 1, smoothing=args.smoothing)
-    viterbi_model = viterbi(trans_model, emiss_model)
-
-    # GENERATE POS SENTENCES FROM TEST WORD SENTENCES
-    test_sentences = extract_word_sentences(word_pos_test_sentences)
-    start_stop_test = insert_start_stop_list(test_sentences)
-    test_sentence_no_pos = extract_word_sentences(word_pos_test_sentences)
-    generated_pos_sentence = [viterbi_model.run(word_sentence) for word_sentence in start_stop_test]
-
-    # GENERATE WORD SENTENCES FOR VALIDATION OF GENERATED POS SENTENCES
-    validation_pos_sentences = extract_pos_sentences(word_pos_test_sentences)
+    if args.tag_dictionary and not args.train_set:
+        parser.error('-tag_dictionary needs the -train_set')
+    if args.hmm_order == 3:
+        if args.smoothing not in ('kn', 'katz') or args.decoder != 'dense':
+            parser.error('-hmm_order 3 needs -smoothing kn|katz and the dense decoder')
+        if args.save_model or args.load_model or args.beam_width or args.beam_threshold is not None:
+            parser.error('-hmm_order 3 can not be saved, loaded or beam pruned')
+    if args.train_set:
+        with instrument.stage('read_train'):
+            word_pos_sentences = read_pos_files(args.train_set, args.workers)
+    if args.load_model:
+        with instrument.stage('load'):
+            trans_model, emiss_model = load_hmm(args.load_model)
+    else:
+        with instrument.stage('train'):
+            trans_model = transition_model(word_pos_sentences, 4, smoothing=args.smoothing, order=args.hmm_order)
+            emiss_model = emission_model(word_pos_sentences, 1, smoothing=args.smoothing)
+    if args.save_model:
+        with instrument.stage('save'):
+            save_hmm(args.save_model, trans_model, emiss_model)
+    with instrument.stage('compile'):
+        if args.decoder == 'dict':
+            viterbi_model = viterbi(trans_model, emiss_model)
+        else:
+            tag_dictionary = (build_tag_dictionary(word_pos_sentences, args.rare_threshold) if args.tag_dictionary
+                              else None)
+            if args.hmm_order == 3:
+                viterbi_model = trigram_viterbi(trans_model, emiss_model, tag_dictionary)
+            else:
+                viterbi_model = dense_viterbi(trans_model, emiss_model, tag_dictionary, args.beam_width,
+                                              args.beam_threshold)
+
+    # TAG THE TEST SENTENCES, WRITING THEM AS THEY COME
+    words = Vocabulary()
+    tags = Vocabulary()
+    correct_count = 0
+    total_not_none_count = 0
+    percentage_sum = 0
+    evaluator = TaggingEvaluator(known_words={word for _, word in emiss_model})
+    with gzip.open(args.test_set, 'rb') as test_file, open(args.test_set_predicted, 'w') as predicted_file:
+        test_sentences, validation_sentences = itertools.tee(
+            instrument.timed_iter('parse', read_pos_sentences(test_file, words, tags)))
+        start_stop_test = (['0START0'] + [words[word_id] for word_id, _ in sentence] + ['0STOP0']
+                           for sentence in test_sentences)
+        tagged_sentences = instrument.timed_iter(
+            'decode', tag_sentences(viterbi_model, start_stop_test, args.workers, timed=True))
+        for sentence, (generated_pos_sentence, seconds) in zip(validation_sentences, tagged_sentences):
+            word_sentence = [words[word_id] for word_id, _ in sentence]
+            validation_pos_sentence = [tags[tag_id] for _, tag_id in sentence]
+            with instrument.stage('serialize'):
+                write_tagged_sentence(predicted_file, word_sentence, generated_pos_sentence)
+            with instrument.stage('evaluate'):
+                evaluator.update(word_sentence, validation_pos_sentence,
+                                 generated_pos_sentence and generated_pos_sentence[0], seconds)
+            instrument.count('sentences')
+            instrument.count('tokens', len(word_sentence))
+            if args.report_every and evaluator.sentences % args.report_every == 0:
+                print(evaluator.report() + '\n')
+
+            # Same measures as calculate_accuracy and percentage_dif
+            if len(validation_pos_sentence) < 15 and generated_pos_sentence is not None:
+                correct_count += generated_pos_sentence[0] == validation_pos_sentence
+                total_not_none_count += 1
+                percentage_sum += percentage_dif([generated_pos_sentence], [validation_pos_sentence])
 
     # PRINT ACCURACY OF GENERATED POS SENTENCES
-    percentage_correct, total_non_none = calculate_accuracy(generated_pos_sentence, validation_pos_sentences)
-    print('Percentage correct ' + str(percentage_correct))
-    percentage_difference = percentage_dif(generated_pos_sentence, validation_pos_sentences)
-    print('Percentage difference ' + str(percentage_difference))
-
-    # SAVE GENERATED POS SENTENCES TO FILE
-    save_lists_to_file(args.test_set_predicted, test_sentence_no_pos, generated_pos_sentence)
+    print('Percentage correct ' + str((correct_count / total_not_none_count) * 100))
+    print('Percentage difference ' + str(percentage_sum / total_not_none_count))
+    print(evaluator.report())
+    if isinstance(viterbi_model, dense_viterbi):
+        for counter in PRUNING_COUNTERS:
+            instrument.count('viterbi_' + counter, getattr(viterbi_model, counter))
+        report = viterbi_model.pruning_report()
+        print('Pruned {0:.1%} of the lattice cells and {1:.1%} of the transitions'.format(
+            report['cells_pruned'], report['transitions_pruned']))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,333 @@
+"""
+Server that loads an n-gram model and an HMM tagger once and answers queries on them, so interactive tools do not
+retrain the models for every query.
+
+Clients connect to a Unix socket (-socket) or to a TCP port on localhost (-port) and send one JSON request per
+line, the server answers every request with one JSON line holding the same id. Requests on one connection are
+handled concurrently, so answers may come in another order:
+    {"id": 1, "op": "score", "sentences": ["the cat sat", ["a", "dog"]]}
+        {"id": 1, "result": {"logprobs": [-21.3, null], "perplexity": 312.5}}    natural logs, null for 0
+    {"id": 2, "op": "conditional", "ngrams": [["the", "cat"]]}
+        {"id": 2, "result": {"probabilities": [0.0012]}}
+    {"id": 3, "op": "tag", "sentences": ["The cat sat ."]}
+        {"id": 3, "result": [{"tags": ["DT", "NN", "VBD", "."], "logprob": -32.1}]}    null if no tagging exists
+    {"id": 4, "op": "info"}
+    {"id": 5, "op": "bogus"}
+        {"id": 5, "error": "ValueError: Unknown op bogus"}
+Sentences are strings of space separated words or lists of words, without start and stop symbols. Scores use the
+smoothing the server was started with and the vocabulary of the model, so the score of a sentence does not depend
+on the other sentences of a request. Conditional probabilities use the kn or katz smoother when there is one and the
+relative frequency otherwise, like a1step2.
+
+Connections are handled with asyncio, the queries run in a process pool that shares the models of the server
+where processes fork. Tag requests are split into chunks over the workers. With -workers 0 they run in a thread.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import multiprocessing
+import os
+import signal
+import socket
+
+import instrument
+from a1step2 import NgramModel
+from a1step2 import read_sentences
+from a1step3 import KatzBackoffSmoother
+from a1step3 import KneserNeySmoother
+from a1step3 import batch_log_probabilities
+from a1step4 import TAG_CHUNK_SIZE
+from a1step4 import build_tag_dictionary
+from a1step4 import dense_viterbi
+from a1step4 import emission_model
+from a1step4 import load_hmm
+from a1step4 import read_pos_files
+from a1step4 import transition_model
+
+SMOOTHINGS = ('no', 'add1', 'gt', 'kn', 'katz')
+MAX_LINE = 1 << 24
+HOST = '127.0.0.1'
+
+_service = None
+
+
+def _words(sentence):
+    return sentence.split() if isinstance(sentence, str) else list(sentence)
+
+
+def _finite(value):
+    """Float for JSON, None for -inf and nan"""
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+class ModelService:
+    """The queries of the server on loaded models, ngram_model or tagger may be None"""
+
+    def __init__(self, ngram_model=None, n=None, smoothing='no', tagger=None):
+        if smoothing not in SMOOTHINGS:
+            raise ValueError('Unknown smoothing {0}, use one of {1}'.format(smoothing, ', '.join(SMOOTHINGS)))
+        self.ngram_model = ngram_model
+        self.n = n if n is not None or ngram_model is None else ngram_model.order
+        self.voc_size = None
+        if ngram_model is not None:
+            if not 1 <= self.n <= ngram_model.order:
+                raise ValueError('-n {0} must be between 1 and the order {1} of the model'.format(
+                    self.n, ngram_model.order))
+            # Possible ngrams over the model vocabulary, like get_all_possible_ngram_count on the train corpus
+            self.voc_size = len(ngram_model.vocabulary) ** self.n
+        self.smoothing = smoothing
+        self.smoother = None
+        if ngram_model is not None and smoothing == 'kn':
+            self.smoother = KneserNeySmoother(ngram_model)
+        elif ngram_model is not None and smoothing == 'katz':
+            self.smoother = KatzBackoffSmoother(ngram_model, 5)
+        self.tagger = tagger
+
+    def _check_ngram_model(self):
+        if self.ngram_model is None:
+            raise ValueError('The server has no n-gram model')
+
+    def score(self, sentences):
+        """Log probability of every sentence between the start and stop symbol and the perplexity of all of them"""
+        self._check_ngram_model()
+        sentences = [['0START0'] + _words(sentence) + ['0STOP0'] for sentence in sentences]
+        log_probs, _, perplexity = batch_log_probabilities(self.ngram_model.counts(self.n),
+                                                           self.ngram_model.counts(self.n - 1), sentences, self.n,
+                                                           self.smoothing, self.voc_size, 5, self.smoother)
+        return {'logprobs': [_finite(log_prob) for log_prob in log_probs], 'perplexity': _finite(perplexity)}
+
+    def conditional(self, ngrams):
+        """P(last word | previous words) of every ngram"""
+        self._check_ngram_model()
+        ngrams = [tuple(_words(ngram)) for ngram in ngrams]
+        if self.smoother is not None:
+            probabilities = [self.smoother.probability(ngram) for ngram in ngrams]
+        else:
+            probabilities = [self.ngram_model.conditional_probability(ngram) for ngram in ngrams]
+        return {'probabilities': [float(probability) for probability in probabilities]}
+
+    def tag(self, sentences):
+        """Tags and log probability of every sentence, None for sentences without a tagging"""
+        if self.tagger is None:
+            raise ValueError('The server has no tagger')
+        tagged = []
+        for sentence in sentences:
+            result = self.tagger.run(['0START0'] + _words(sentence) + ['0STOP0'])
+            tagged.append(None if result is None else {'tags': result[0], 'logprob': _finite(result[1])})
+        return tagged
+
+    def info(self):
+        return {
+            'ngram_order': self.n,
+            'smoothing': self.smoothing if self.ngram_model is not None else None,
+            'vocabulary': len(self.ngram_model.vocabulary) if self.ngram_model is not None else None,
+            'tags': len(self.tagger.states) if self.tagger is not None else None,
+        }
+
+
+def _set_service(service):
+    global _service
+    _service = service
+
+
+def _start_worker(service=None):
+    """Workers leave SIGINT and SIGTERM to the server, which shuts the pool down"""
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if service is not None:
+        _set_service(service)
+
+
+def _call_service(method, args):
+    return getattr(_service, method)(*args)
+
+
+class ModelServer:
+    """Answers requests of asyncio connections with a ModelService in a pool of workers"""
+
+    def __init__(self, service, workers=1, chunk_size=TAG_CHUNK_SIZE):
+        self.service = service
+        self.chunk_size = chunk_size
+        _set_service(service)
+        if workers < 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        elif 'fork' in multiprocessing.get_all_start_methods():
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('fork'),
+                                                                   initializer=_start_worker)
+        else:
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_start_worker,
+                                                                   initargs=(service,))
+
+    async def _call(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, _call_service, method, args)
+
+    async def handle_request(self, request):
+        """Returns the result of a request dictionary, raises ValueError for bad requests"""
+        op = request.get('op')
+        instrument.count('requests_' + str(op))
+        if op == 'score':
+            return await self._call('score', request['sentences'])
+        if op == 'conditional':
+            return await self._call('conditional', request['ngrams'])
+        if op == 'tag':
+            sentences = request['sentences']
+            chunks = [sentences[start:start + self.chunk_size] for start in range(0, len(sentences), self.chunk_size)]
+            tagged = await asyncio.gather(*(self._call('tag', chunk) for chunk in chunks))
+            return [result for chunk in tagged for result in chunk]
+        if op == 'info':
+            return self.service.info()
+        raise ValueError('Unknown op {0}'.format(op))
+
+    async def _answer(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('A request is a JSON object')
+            request_id = request.get('id')
+            response = {'id': request_id, 'result': await self.handle_request(request)}
+        except Exception as error:  # Every request gets an answer, whatever went wrong
+            response = {'id': request_id, 'error': '{0}: {1}'.format(type(error).__name__, error)}
+        if not writer.is_closing():
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    async def handle_connection(self, reader, writer):
+        pending = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # Line longer than MAX_LINE
+                    writer.write(json.dumps({'id': None, 'error': 'Request too long'}).encode('utf-8') + b'\n')
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.ensure_future(self._answer(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, port=None, host=HOST):
+        """Serves until SIGINT or SIGTERM"""
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, socket_path, limit=MAX_LINE)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE)
+            address = '{0}:{1}'.format(host, server.sockets[0].getsockname()[1])
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        print('Serving on {0}'.format(address), flush=True)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            if socket_path is not None and os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+
+class ModelClient:
+    """Blocking client of a ModelServer for interactive tools, request returns the result of one request"""
+
+    def __init__(self, socket_path=None, port=None, host=HOST):
+        if socket_path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(socket_path)
+        else:
+            self.socket = socket.create_connection((host, port))
+        self.file = self.socket.makefile('rwb')
+        self.next_id = 0
+
+    def request(self, op, **fields):
+        self.next_id += 1
+        fields.update(id=self.next_id, op=op)
+        self.file.write(json.dumps(fields).encode('utf-8') + b'\n')
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_service(args):
+    """Loads or trains the models named by the command line arguments"""
+    ngram_model = None
+    if args.ngram_model:
+        ngram_model = NgramModel.load(args.ngram_model)
+    elif args.corpus:
+        ngram_model = NgramModel.from_sentences(read_sentences(args.corpus), args.n, workers=max(args.workers, 1))
+
+    tagger = None
+    if args.hmm_model or args.train_set:
+        word_pos_sentences = read_pos_files(args.train_set, max(args.workers, 1)) if args.train_set else None
+        if args.hmm_model:
+            trans_model, emiss_model = load_hmm(args.hmm_model)
+        else:
+            trans_model = transition_model(word_pos_sentences, 4, smoothing=args.hmm_smoothing)
+            emiss_model = emission_model(word_pos_sentences, 1, smoothing=args.hmm_smoothing)
+        tag_dictionary = build_tag_dictionary(word_pos_sentences) if args.tag_dictionary else None
+        tagger = dense_viterbi(trans_model, emiss_model, tag_dictionary)
+    return ModelService(ngram_model, args.n, args.smoothing, tagger)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-socket', type=str, help='path of the Unix socket to listen on')
+    parser.add_argument('-port', type=int, help='TCP port to listen on at localhost, 0 for any free port')
+    parser.add_argument('-ngram_model', type=str, help='n-gram model saved with a1step3 -save_model')
+    parser.add_argument('-corpus', type=str, help='text file to count the n-gram model from instead')
+    parser.add_argument('-n', type=int, help='order of the scores, the order of the model by default')
+    parser.add_argument('-smoothing', type=str, default='no', choices=SMOOTHINGS,
+                        help='smoothing of the sentence scores')
+    parser.add_argument('-hmm_model', type=str, help='tagger model saved with a1step4 -save_model')
+    parser.add_argument('-train_set', type=str, nargs='+', help='path(s) to train the tagger on instead')
+    parser.add_argument('-hmm_smoothing', type=str, default='yes', help='yes|no|kn|katz, yes is Good Turing')
+    parser.add_argument('-tag_dictionary', action='store_true',
+                        help='only consider the tags a word was seen with in the train set')
+    parser.add_argument('-workers', '--workers', type=int, default=1,
+                        help='number of processes answering queries, 0 for a thread in the server process')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.enable_from_args(args)
+
+    if (args.socket is None) == (args.port is None):
+        parser.error('give either -socket or -port')
+    if args.corpus and args.n is None:
+        parser.error('-corpus needs -n')
+    if not (args.ngram_model or args.corpus or args.hmm_model or args.train_set):
+        parser.error('give an n-gram model (-ngram_model or -corpus) and/or a tagger (-hmm_model or -train_set)')
+    if args.tag_dictionary and not args.train_set:
+        parser.error('-tag_dictionary needs the -train_set')
+
+    with instrument.stage('load'):
+        try:
+            service = load_service(args)
+        except ValueError as error:
+            parser.error(str(error))
+    asyncio.run(ModelServer(service, args.workers).serve(args.socket, args.port))
@@ -0,0 +1,95 @@
+"""
+Versioned binary model file that can be memory-mapped.
+
+Layout:
+    8 bytes   magic b'NTIMODEL'
+    4 bytes   little endian uint32 format version
+    4 bytes   little endian uint32 length of the header
+    header    utf-8 JSON: {"kind": ..., "meta": {...}, "arrays": {name: {"dtype", "shape", "offset"}}}
+    arrays    raw array data, every array starts at a multiple of ALIGNMENT bytes
+
+Loading maps the arrays straight from the file, so a process can start answering queries without reading the
+whole model and several processes share the pages of one model file.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'NTIMODEL'
+VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sII')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def strings_to_arrays(strings):
+    """Packs a list of strings into a utf-8 byte array and an array of offsets"""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def arrays_to_strings(blob, offsets):
+    """Unpacks strings packed by strings_to_arrays"""
+    data = bytes(blob)
+    offsets = offsets.tolist()
+    return [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def save_arrays(path, kind, arrays, meta=None):
+    """Writes named numpy arrays and a dictionary of JSON serializable metadata to a model file"""
+    header = {'kind': kind, 'meta': meta or {}, 'arrays': {}}
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    for name, array in arrays.items():
+        if array.dtype == object:
+            raise ValueError('Array {0} holds python objects and can not be saved'.format(name))
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    # Offsets depend on the header length, so they are relative to the aligned end of the header
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name]['offset'] = offset
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(PREAMBLE.size + len(header_bytes))
+
+    with open(path, 'wb') as model_file:
+        model_file.write(PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+        model_file.write(header_bytes)
+        for name, array in arrays.items():
+            model_file.seek(data_start + header['arrays'][name]['offset'])
+            model_file.write(array.tobytes())
+        model_file.truncate(data_start + offset)
+
+
+def load_arrays(path, kind=None, mmap=True):
+    """Reads a model file, returns the metadata and a dictionary of arrays. With mmap the arrays are read-only
+    views on the file instead of copies in memory."""
+    with open(path, 'rb') as model_file:
+        magic, version, header_length = PREAMBLE.unpack(model_file.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError('{0} is not a model file'.format(path))
+        if version != VERSION:
+            raise ValueError('{0} has format version {1}, expected {2}'.format(path, version, VERSION))
+        header = json.loads(model_file.read(header_length).decode('utf-8'))
+    if kind is not None and header['kind'] != kind:
+        raise ValueError('{0} holds a {1} model, expected {2}'.format(path, header['kind'], kind))
+
+    data_start = _align(PREAMBLE.size + header_length)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        dtype = np.dtype(spec['dtype'])
+        if mmap and dtype.itemsize * int(np.prod(shape)) > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + spec['offset'], shape=shape)
+        else:
+            with open(path, 'rb') as model_file:
+                model_file.seek(data_start + spec['offset'])
+                arrays[name] = np.fromfile(model_file, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return header['meta'], arrays
@@ -46,31 +46,324 @@ Binarizes a file containing trees, outputting binarized trees as strings.
 """
 
 import argparse
-import re
+import gzip
+import io
+import itertools
+import multiprocessing
+import os
+import time
 import unittest
+from array import array
+from collections import deque
 
+import numpy as np
 import progressbar
 
+import instrument
+
+
+READ_BLOCK_SIZE = 1 << 20
+CHUNK_LINES = 1000
+OPEN = -2
+CLOSE = -1
+
+
+def tokenize_trees(text):
+    """Returns the brackets, labels and words of a string of trees. Padding the brackets with spaces and splitting
+    once is about twice as fast as a regex scanner."""
+    return text.replace('(', ' ( ').replace(')', ' ) ').split()
+
+
+class SymbolTable:
+    """Interns labels and words, every distinct string gets an integer id"""
+
+    def __init__(self, symbols=()):
+        self.ids = {}
+        self.symbols = []
+        for symbol in symbols:
+            self.add(symbol)
+
+    def add(self, symbol):
+        """Returns the id of a symbol, adding it if it is new"""
+        idx = self.ids.get(symbol)
+        if idx is None:
+            idx = self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return idx
+
+    def __getitem__(self, idx):
+        return self.symbols[idx]
+
+    def __contains__(self, symbol):
+        return symbol in self.ids
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+class Tree:
+    """Compact tree of interned symbols. The nodes are stored in preorder: labels[i] is the symbol id of node i and
+    arity[i] its number of children, 0 for the words at the leaves. The children of a node follow it, each
+    followed by its own subtree."""
+    __slots__ = ('symbols', 'labels', 'arity')
+
+    def __init__(self, symbols, labels, arity):
+        self.symbols = symbols
+        self.labels = labels
+        self.arity = arity
+
+    def __len__(self):
+        return len(self.labels)
+
+    def label(self, node):
+        return self.symbols[self.labels[node]]
+
+    def subtree_ends(self):
+        """Returns for every node the index just after its subtree"""
+        arity = self.arity
+        ends = array('i', bytes(4 * len(arity)))
+        for node in range(len(arity) - 1, -1, -1):
+            end = node + 1
+            for _ in range(arity[node]):
+                end = ends[end]
+            ends[node] = end
+        return ends
+
+    def children(self, node, ends=None):
+        """Returns the indices of the children of a node"""
+        if ends is None:
+            ends = self.subtree_ends()
+        children = []
+        child = node + 1
+        for _ in range(self.arity[node]):
+            children.append(child)
+            child = ends[child]
+        return children
+
+    def to_list(self):
+        """Returns the tree as a nested list in the format of parse_to_list"""
+        symbols = self.symbols.symbols
+        root = []
+        stack = [[root, 1]]
+        for label, arity in zip(self.labels, self.arity):
+            parent = stack[-1]
+            parent[1] -= 1
+            if arity:
+                node = [symbols[label]]
+                parent[0].append(node)
+                stack.append([node, arity])
+            else:
+                parent[0].append(symbols[label])
+            while stack[-1][1] == 0 and len(stack) > 1:
+                stack.pop()
+        return root[0]
+
+    def parts(self):
+        """Returns the pieces of the bracketed string of the tree, in one traversal"""
+        symbols = self.symbols.symbols
+        parts = []
+        remaining = []
+        for label, arity in zip(self.labels, self.arity):
+            if remaining:
+                remaining[-1] -= 1
+            if arity:
+                parts.append(' (' + escape_symbol(symbols[label]))
+                remaining.append(arity)
+                continue
+            parts.append(' ' + escape_symbol(symbols[label]))
+            while remaining and remaining[-1] == 0:
+                parts.append(')')
+                del remaining[-1]
+        if parts:
+            parts[0] = parts[0][1:]
+        return parts
+
+    def write(self, f):
+        """Writes the tree as a bracketed string to a text file"""
+        f.write(''.join(self.parts()))
+
+    def to_string(self):
+        return ''.join(self.parts())
+
+    @classmethod
+    def from_list(cls, nested_list, symbols=None):
+        """Builds a tree from a nested list in the format of parse_to_list"""
+        if symbols is None:
+            symbols = SymbolTable()
+        labels = array('i')
+        arity = array('i')
+        stack = [nested_list]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                labels.append(symbols.add(node[0]))
+                arity.append(len(node) - 1)
+                stack.extend(reversed(node[1:]))
+            else:
+                labels.append(symbols.add(node))
+                arity.append(0)
+        return cls(symbols, labels, arity)
+
+
+def _block_trees(tokens, symbols, final=True):
+    """Builds the trees of a list of tokens in one pass of array operations instead of a python loop per token.
+    :return: the trees, and the number of tokens used. The tokens of a last tree that is not closed are not used,
+    unless final in which case it is an error
+    """
+    codes = {'(': OPEN, ')': CLOSE}
+    for token in dict.fromkeys(tokens):
+        if token not in codes:
+            codes[token] = symbols.add(token)
+    codes = np.fromiter(map(codes.__getitem__, tokens), dtype=np.int32, count=len(tokens))
+
+    is_open = codes == OPEN
+    is_close = codes == CLOSE
+    depth = np.cumsum(is_open, dtype=np.int64) - np.cumsum(is_close, dtype=np.int64)
+    if len(depth) and depth.min() < 0:
+        raise ValueError('Unbalanced closing bracket')
+    closed = np.flatnonzero(depth == 0)
+    used = int(closed[-1]) + 1 if len(closed) else 0
+    if used < len(codes):
+        if final:
+            raise ValueError('Unbalanced opening bracket at the end of the input')
+        codes, is_open, depth = codes[:used], is_open[:used], depth[:used]
+    is_label = np.zeros(len(codes), dtype=bool)
+    is_label[1:] = is_open[:-1] & (codes[1:] >= 0)
+    is_word = (codes >= 0) & ~is_label
+    if (is_word & (depth == 0)).any():
+        raise ValueError('Word outside of a tree')
+
+    # Nodes are the opening brackets, labelled by the next token, and the words
+    node_positions = np.flatnonzero(is_open | is_word)
+    labels = codes[node_positions]
+    node_is_open = is_open[node_positions]
+    label_positions = node_positions[node_is_open] + 1
+    labels[node_is_open] = np.where(is_label[label_positions], codes[label_positions], 0)
+    if not is_label[label_positions].all():  # Outer brackets of the Penn treebank have no label
+        labels[node_is_open] = np.where(is_label[label_positions], labels[node_is_open], symbols.add(''))
+
+    # The parent of a node is the last opening bracket before it at the depth of the parent
+    parent_depth = depth[node_positions] - node_is_open
+    open_nodes = np.flatnonzero(node_is_open)
+    open_depth = depth[node_positions[open_nodes]]
+    order = np.argsort(open_depth, kind='stable')
+    size = len(codes) + 1
+    open_keys = open_depth[order] * size + node_positions[open_nodes[order]]
+    has_parent = parent_depth > 0
+    queries = parent_depth[has_parent] * size + node_positions[has_parent]
+    parents = open_nodes[order[np.searchsorted(open_keys, queries) - 1]]
+    arity = np.bincount(parents, minlength=len(labels)).astype(np.int32)
+    if (arity[open_nodes] == 0).any():
+        raise ValueError('Empty constituent')
+
+    roots = np.flatnonzero(~has_parent).tolist() + [len(labels)]
+    labels = labels.astype(np.int32).tobytes()
+    arity = arity.tobytes()
+    trees = []
+    for start, end in zip(roots[:-1], roots[1:]):
+        tree_labels = array('i')
+        tree_labels.frombytes(labels[4 * start:4 * end])
+        tree_arity = array('i')
+        tree_arity.frombytes(arity[4 * start:4 * end])
+        trees.append(Tree(symbols, tree_labels, tree_arity))
+    return trees, used
+
+
+def read_trees(lines, symbols=None, block_size=READ_BLOCK_SIZE):
+    """Streaming reader for S-expression trees, yields one Tree per tree so trees may span several lines and blank
+    lines are skipped. All trees share one SymbolTable.
+
+    Lines are collected in blocks of about block_size characters that are tokenized at once. A tree that is not
+    closed at the end of a block is carried over to the next one.
+    :param lines: iterable of strings, like an open treebank file
+    """
+    if symbols is None:
+        symbols = SymbolTable()
+    if isinstance(lines, str):
+        lines = (lines,)
+    carry = []
+    block = []
+    block_length = 0
+    lines = iter(lines)
+    while True:
+        line = next(lines, None)
+        if line is not None:
+            block.append(line)
+            block_length += len(line)
+            if block_length < block_size:
+                continue
+        tokens = carry + tokenize_trees(''.join(block))
+        block = []
+        block_length = 0
+        trees, used = _block_trees(tokens, symbols, final=line is None)
+        carry = tokens[used:]
+        yield from trees
+        if line is None:
+            return
+
+
+def parse_tree(sentence, symbols=None):
+    """Returns the Tree of a string holding one tree. Single trees are parsed with a plain loop over the tokens,
+    which is faster than the array operations of read_trees for short input."""
+    if symbols is None:
+        symbols = SymbolTable()
+    ids = symbols.ids
+    add = symbols.add
+    labels = array('i')
+    arity = array('i')
+    stack = []
+    expect_label = False
+    closed = False
+    for token in tokenize_trees(sentence):
+        if closed:
+            raise ValueError('Text after the tree in {0!r}'.format(sentence))
+        if token == '(':
+            if expect_label:  # Node without label, like the outer brackets of the Penn treebank
+                labels[-1] = add('')
+            if stack:
+                arity[stack[-1]] += 1
+            stack.append(len(labels))
+            labels.append(-1)
+            arity.append(0)
+            expect_label = True
+        elif token == ')':
+            if not stack:
+                raise ValueError('Unbalanced closing bracket in {0!r}'.format(sentence))
+            node = stack.pop()
+            if arity[node] == 0:
+                raise ValueError('Empty constituent in {0!r}'.format(sentence))
+            closed = not stack
+        else:
+            idx = ids.get(token)
+            if idx is None:
+                idx = add(token)
+            if expect_label:
+                labels[-1] = idx
+                expect_label = False
+            elif not stack:
+                raise ValueError('Word {0!r} outside of a tree'.format(token))
+            else:
+                arity[stack[-1]] += 1
+                labels.append(idx)
+                arity.append(0)
+    if not closed:
+        raise ValueError('No complete tree in {0!r}'.format(sentence))
+    return Tree(symbols, labels, arity)
+
 
 def parse_to_list(sentence):
-    """Returns a nested list from a tree in the form of a string.
-    Works by splitting all elements of the string using regex and iterating over them."""
-    accum = []
-    nested_list = []
-    regex = re.compile(r'([^(^)\s]+|\()|(\))')
-    for termtypes in re.finditer(regex, sentence):
-        tt = termtypes.group(0).strip()
-        if tt == '(':
-            accum.append(nested_list)
+    """Returns a nested list from a tree in the form of a string."""
+    stack = [[]]
+    for token in tokenize_trees(sentence):
+        if token == '(':
             nested_list = []
-        elif tt == ')':
-            tmp = nested_list
-            nested_list = accum[-1]
-            nested_list.append(tmp)
-            del accum[-1]
-        else:  # A word
-            nested_list.append(tt)
-    return nested_list[0]  # Remove outer list
+            stack[-1].append(nested_list)
+            stack.append(nested_list)
+        elif token == ')':
+            del stack[-1]
+        else:  # A label or word
+            stack[-1].append(token)
+    return stack[0][0]  # Remove outer list
 
 
 def binarize(nested_list):
@@ -90,16 +383,40 @@ def binarize(nested_list):
     return nested_list
 
 
+def escape_symbol(symbol):
+    """Escapes brackets in a label or word the way the Penn treebank does"""
+    if '(' in symbol or ')' in symbol:
+        return symbol.replace('(', '-LRB-').replace(')', '-RRB-')
+    return symbol
+
+
+def nested_list_parts(nested_list):
+    """Returns the pieces of the bracketed string of a nested list tree, in one traversal"""
+    parts = []
+    stack = [nested_list]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            parts.append(')')
+        elif isinstance(node, list):
+            parts.append(' (' + escape_symbol(node[0]))
+            stack.append(None)
+            stack.extend(reversed(node[1:]))
+        else:
+            parts.append(' ' + escape_symbol(node))
+    if parts:
+        parts[0] = parts[0][1:]
+    return parts
+
+
+def write_nested_list(f, nested_list):
+    """Writes a nested list tree as a bracketed string to a text file"""
+    f.write(''.join(nested_list_parts(nested_list)))
+
+
 def binarized_to_string(nested_list):
     """Transforms a list to a string, removing list elements"""
-    return str(nested_list).replace("[", "(") \
-        .replace(']', ')') \
-        .replace("')", ")") \
-        .replace("('", "(") \
-        .replace(', ', ' ') \
-        .replace("' ", " ") \
-        .replace(" '", " ") \
-        .replace('"', '')
+    return ''.join(nested_list_parts(nested_list))
 
 
 class TestBStep1(unittest.TestCase):
@@ -129,24 +446,99 @@ class TestBStep1(unittest.TestCase):
             binarized_list = binarize(parsed)
             self.assertEqual(binarized_to_string(binarized_list), test_bin_sentence)
 
+    def test_read_trees(self):
+        symbols = SymbolTable()
+        trees = list(read_trees(iter('\n\n'.join(self.test_string_sentences).splitlines(True)), symbols,
+                                block_size=100))
+        self.assertEqual([tree.to_list() for tree in trees],
+                         [parse_to_list(sentence) for sentence in self.test_string_sentences])
+        for tree in trees:
+            self.assertEqual(Tree.from_list(tree.to_list(), symbols).labels, tree.labels)
+            self.assertEqual(tree.subtree_ends()[0], len(tree))
+        self.assertEqual([trees[0].label(child) for child in trees[0].children(1)], ['NP', 'VP', '.'])
 
-def binarize_to_file(infile, outfile):
-    """Reads all lines form a file, binarizes them, and writes the binarized tree to a new file"""
-    f_out = open(outfile, 'w')
-    num_lines = sum(1 for _ in open(infile))
-    count = 0
-    pbar = progressbar.ProgressBar(widgets=[progressbar.Percentage(), progressbar.Bar()], maxval=num_lines).start()
+    def test_serialize(self):
+        symbols = SymbolTable()
+        for sentence in self.test_string_sentences:
+            self.assertEqual(binarized_to_string(parse_to_list(sentence)), sentence)
+            self.assertEqual(parse_tree(sentence, symbols).to_string(), sentence)
+        self.assertEqual(binarized_to_string(['NP', ['-LRB-', '('], ['NN', "''s"], ['-RRB-', ')']]),
+                         "(NP (-LRB- -LRB-) (NN ''s) (-RRB- -RRB-))")
 
+    def test_read_trees_multiline(self):
+        tree = parse_tree('( (S (NP x)\n (VP y)))\n')
+        self.assertEqual(tree.to_list(), ['', ['S', ['NP', 'x'], ['VP', 'y']]])
+        for invalid in ['(S (NP x)', '(S x))', 'x (S y)', '(S (NP) y)']:
+            with self.assertRaises(ValueError):
+                parse_tree(invalid)
+
+
+def open_text(path, mode='r'):
+    """Opens a text file, gzip compressed if the name ends in .gz"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def binarize_lines(lines):
+    """Binarizes a chunk of lines holding one tree each, blank lines stay blank"""
+    return ''.join(binarized_to_string(binarize(parse_to_list(line))) + '\n' if line.strip() else '\n'
+                   for line in lines)
+
+
+def ordered_imap(pool, func, tasks, max_pending):
+    """Like Pool.imap, but takes tasks from the iterable only when fewer than max_pending are in flight, so a
+    long stream of tasks is never read ahead into memory. Results are yielded in task order."""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def transform_file(infile, outfile, transform, workers=1, chunk_size=CHUNK_LINES, progress_interval=0.5):
+    """Streams a treebank file through transform and writes the results in input order.
+
+    The input is read in chunks of chunk_size lines. transform takes a list of lines and returns the text to write
+    for them, it has to be a picklable module level function when workers > 1, in which case the chunks are handed
+    to a process pool with a few chunks per worker in flight. Files ending in .gz are read and written with gzip.
+    The progress bar follows the bytes read from the input file and is redrawn at most every progress_interval
+    seconds."""
+    with open(infile, 'rb') as raw_in, open_text(outfile, 'w') as f_out:
+        stream = gzip.GzipFile(fileobj=raw_in) if infile.endswith('.gz') else raw_in
+        f_in = io.TextIOWrapper(stream, encoding='utf-8')
+        size = max(os.fstat(raw_in.fileno()).st_size, 1)
+        pbar = progressbar.ProgressBar(widgets=[progressbar.Percentage(), progressbar.Bar()], maxval=size).start()
+        chunks = instrument.timed_iter('read', iter(lambda: list(itertools.islice(f_in, chunk_size)), []))
+        last_update = time.monotonic()
+
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = ordered_imap(pool, transform, chunks, 2 * workers)
+        else:
+            pool = None
+            results = map(transform, chunks)
+        try:
+            for text in instrument.timed_iter('transform', results):
+                with instrument.stage('write'):
+                    f_out.write(text)
+                instrument.count('lines', text.count('\n'))
+                now = time.monotonic()
+                if now - last_update >= progress_interval:
+                    pbar.update(min(raw_in.tell(), size))
+                    last_update = now
+        finally:
+            if pool is not None:
+                pool.terminate()
+        pbar.finish()
+
+
+def binarize_to_file(infile, outfile, workers=1):
+    """Reads all lines form a file, binarizes them, and writes the binarized tree to a new file"""
     print('Binarizing...')
-    with open(infile, 'r') as f_in:
-        for line in f_in:
-            count += 1
-            pbar.update(count)
-            if line == '\n':
-                f_out.write('\n')
-            else:
-                binarized_line = binarized_to_string(binarize(parse_to_list(line)))
-                f_out.write(binarized_line + '\n')
+    transform_file(infile, outfile, binarize_lines, workers)
     print('Done.')
 
 
@@ -155,9 +547,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-infile', type=str, help='Path to file containing S-Expressions')
     parser.add_argument('-outfile', type=str, help='Path to where tot save binary S-Expressions')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='Number of processes, .gz files are read and written gzipped')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.enable_from_args(args)
 
     if not args.infile and not args.outfile:
         unittest.main()
     else:
-        binarize_to_file(args.infile, args.outfile)
+        binarize_to_file(args.infile, args.outfile, args.workers)
@@ -1,16 +1,24 @@
 #!/usr/bin/env python3.5
 
 import argparse
+import functools
 import re
 import unittest
+from array import array
 
-import progressbar
-
+import instrument
+from b1step1 import SymbolTable
+from b1step1 import Tree
+from b1step1 import binarize
 from b1step1 import binarized_to_string
 from b1step1 import parse_to_list
+from b1step1 import parse_tree
+from b1step1 import transform_file
 
 __author__ = 'Yorick de Boer [10786015]'
 
+PARENT_BASE = re.compile(r'\w+')
+
 
 def vertical_markovization(nested_list, v_order=2):
     """Executes vertical markovization on a tree in the formatted as a nested list."""
@@ -71,6 +79,101 @@ def vertical_horizonantal_markovization(nested_list, h_order=2, v_order=2):
     return horizontally_markovized
 
 
+class Markovizer:
+    """Binarization with horizontal and vertical markovization of any order, on compact trees.
+
+    Every node except the root, preterminals and words gets the first word characters of the labels of its
+    v_order - 1 nearest original ancestors appended, like NP^S^ROOT. A node with children c1..cn gets c1 and an
+    @ node for the rest, labelled with the annotated parent and the labels of the last h_order children it already
+    covers, like @NP^S->_DT_JJ; the @ node of the last child is unary. h_order None keeps all children, like
+    binarize. For h_order >= 2 and v_order <= 2 the output is the same as vertical_horizonantal_markovization.
+
+    The tree is transformed in one pass over its preorder arrays with an explicit stack, so deep trees do not hit
+    the recursion limit. Labels are built from symbol ids and cached per Markovizer."""
+
+    def __init__(self, h_order=None, v_order=1, symbols=None):
+        if v_order < 1 or (h_order is not None and h_order < 0):
+            raise ValueError('Markovization needs v_order >= 1 and h_order >= 0')
+        self.h_order = h_order
+        self.v_order = v_order
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self._bases = {}
+        self._vertical = {}
+        self._horizontal = {}
+
+    def _base(self, label):
+        """Returns the symbol id of the part of a label used in the annotation of its descendants"""
+        base = self._bases.get(label)
+        if base is None:
+            symbol = self.symbols[label]
+            match = PARENT_BASE.search(symbol)
+            base = self._bases[label] = self.symbols.add(match.group(0) if match else symbol)
+        return base
+
+    def _vertical_label(self, label, ancestors):
+        key = (label, ancestors)
+        annotated = self._vertical.get(key)
+        if annotated is None:
+            symbols = self.symbols
+            annotated = self._vertical[key] = symbols.add(
+                '^'.join([symbols[label]] + [symbols[ancestor] for ancestor in ancestors]))
+        return annotated
+
+    def _horizontal_label(self, parent, history):
+        key = (parent, history)
+        label = self._horizontal.get(key)
+        if label is None:
+            symbols = self.symbols
+            label = self._horizontal[key] = symbols.add(
+                '@' + symbols[parent] + '->_' + '_'.join(symbols[sibling] for sibling in history))
+        return label
+
+    def markovize(self, tree):
+        """Returns the markovized copy of a Tree, in the symbol table of this Markovizer"""
+        if tree.symbols is not self.symbols:
+            tree = Tree.from_list(tree.to_list(), self.symbols)
+        in_labels = tree.labels
+        in_arity = tree.arity
+        labels = array('i')
+        arity = array('i')
+        h_order = self.h_order if self.h_order is not None else len(in_labels)
+        depth = self.v_order - 1
+
+        # A frame per open node: [annotated label, number of children, children seen, ancestors, history]
+        stack = []
+        for node, (label, num_children) in enumerate(zip(in_labels, in_arity)):
+            if stack:
+                parent = stack[-1]
+                parent[2] += 1
+                if parent[2] > 1:
+                    history = parent[4]
+                    labels.append(self._horizontal_label(parent[0], tuple(history[max(len(history) - h_order, 0):])))
+                    arity.append(2 if parent[2] < parent[1] else 1)
+                parent[4].append(label)
+            if num_children == 0:
+                labels.append(label)
+                arity.append(0)
+                while stack and stack[-1][2] == stack[-1][1]:
+                    del stack[-1]
+                continue
+
+            preterminal = num_children == 1 and in_arity[node + 1] == 0
+            if stack and not preterminal and depth:
+                annotated = self._vertical_label(label, stack[-1][3][:depth])
+            else:
+                annotated = label
+            ancestors = (self._base(label),) + (stack[-1][3][:depth - 1] if stack and depth > 1 else ())
+            labels.append(annotated)
+            arity.append(min(num_children, 2))
+            stack.append([annotated, num_children, 0, ancestors, []])
+        return Tree(self.symbols, labels, arity)
+
+
+def markovize(nested_list, h_order=None, v_order=1):
+    """Markovizes a tree formatted as a nested list with a Markovizer"""
+    return Markovizer(h_order, v_order).markovize(Tree.from_list(nested_list)).to_list()
+
+
 class TestBStep2(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
@@ -98,25 +201,51 @@ class TestBStep2(unittest.TestCase):
             binarized_list = vertical_horizonantal_markovization(parsed)
             self.assertEqual(binarized_to_string(binarized_list), test_bin_sentence)
 
+    def test_markovizer(self):
+        for test_string_sentence, test_bin_sentence in zip(self.test_string_sentences, self.test_markov_sentences):
+            self.assertEqual(Markovizer(2, 2).markovize(parse_tree(test_string_sentence)).to_string(),
+                             test_bin_sentence)
+            for h_order in (2, 3, 5):
+                for v_order in (1, 2):
+                    self.assertEqual(markovize(parse_to_list(test_string_sentence), h_order, v_order),
+                                     vertical_horizonantal_markovization(parse_to_list(test_string_sentence),
+                                                                         h_order, v_order))
+            self.assertEqual(markovize(parse_to_list(test_string_sentence)),
+                             binarize(parse_to_list(test_string_sentence)))
+
+    def test_markovizer_orders(self):
+        tree = parse_tree(self.test_string_sentences[0])
+        self.assertEqual(Markovizer(1, 3).markovize(tree).to_string(),
+                         '(ROOT (S^ROOT (NP^S^ROOT (NNP Ms.) (@NP^S^ROOT->_NNP (NNP Haag))) (@S^ROOT->_NP '
+                         '(VP^S^ROOT (VBZ plays) (@VP^S^ROOT->_VBZ (NP^VP^S (NNP Elianti)))) (@S^ROOT->_VP (. .)))))')
+        self.assertEqual(Markovizer(0, 1).markovize(tree).to_string(),
+                         '(ROOT (S (NP (NNP Ms.) (@NP->_ (NNP Haag))) (@S->_ (VP (VBZ plays) (@VP->_ (NP (NNP '
+                         'Elianti)))) (@S->_ (. .)))))')
+
+    def test_markovizer_deep_tree(self):
+        depth = 5000
+        tree = parse_tree('(ROOT ' + '(X (Y y) ' * depth + '(Z z)' + ')' * (depth + 1))
+        markovized = Markovizer(2, 3).markovize(tree)
+        self.assertEqual(len(markovized), len(tree) + depth)
 
-def markov_to_file(infile, outfile, h_order, v_order):
-    """Reads all lines form a file, markovizes them, and writes the markov tree to a new file"""
-    f_out = open(outfile, 'w')
-    num_lines = sum(1 for _ in open(infile))
-    count = 0
-    pbar = progressbar.ProgressBar(widgets=[progressbar.Percentage(), progressbar.Bar()], maxval=num_lines).start()
 
+# Markovizer per (h, v) order of the process, so its label caches are reused for every chunk
+_markovizers = {}
+
+
+def markov_lines(lines, h_order, v_order):
+    """Markovizes a chunk of lines holding one tree each, blank lines stay blank"""
+    markovizer = _markovizers.get((h_order, v_order))
+    if markovizer is None:
+        markovizer = _markovizers[h_order, v_order] = Markovizer(h_order, v_order)
+    return ''.join(markovizer.markovize(parse_tree(line, markovizer.symbols)).to_string() + '\n'
+                   if line.strip() else '\n' for line in lines)
+
+
+def markov_to_file(infile, outfile, h_order, v_order, workers=1):
+    """Reads all lines form a file, markovizes them, and writes the markov tree to a new file"""
     print('Binarizing...')
-    with open(infile, 'r') as f_in:
-        for line in f_in:
-            count += 1
-            pbar.update(count)
-            if line == '\n':
-                f_out.write('\n')
-            else:
-                binarized_line = binarized_to_string(
-                    vertical_horizonantal_markovization(parse_to_list(line), h_order, v_order))
-                f_out.write(binarized_line + '\n')
+    transform_file(infile, outfile, functools.partial(markov_lines, h_order=h_order, v_order=v_order), workers)
     print('Done.')
 
 
@@ -127,9 +256,13 @@ if __name__ == '__main__':
     parser.add_argument('-output', type=str, help='Path to save markov S-Expressions')
     parser.add_argument('-hor', type=int, help='Horizontal markovization parameter')
     parser.add_argument('-ver', type=int, help='Vertical markovization parameter')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='Number of processes, .gz files are read and written gzipped')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.enable_from_args(args)
 
     if not args.input and not args.output:
         unittest.main()
     else:
-        markov_to_file(args.input, args.output, args.hor, args.ver)
+        markov_to_file(args.input, args.output, args.hor, args.ver, args.workers)
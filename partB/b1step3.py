@@ -0,0 +1,287 @@
+#!/usr/bin/env python3.5
+"""
+Estimates a PCFG from binarized or markovized trees.
+
+Rules are counted into integer arrays and stored with their relative frequency log probabilities
+P(rule | parent) in three tables laid out for a chart parser:
+    binary   parent -> left right, sorted by parent, left and right with offsets per parent
+    unary    parent -> child, sorted by parent and child with offsets per parent
+    lexical  tag -> word, sorted by word and tag with offsets per word
+Unknown words get P(unknown | tag) estimated from the words seen once.
+"""
+
+import argparse
+import os
+import tempfile
+import unittest
+from array import array
+
+import numpy as np
+
+import instrument
+from b1step1 import SymbolTable
+from b1step1 import Tree
+from b1step1 import open_text
+from b1step1 import parse_tree
+from b1step1 import read_trees
+from b1step2 import Markovizer
+
+GRAMMAR_VERSION = 1
+START_SYMBOL = 'ROOT'
+
+
+def count_rules(trees, symbols=None):
+    """Collects the rules of trees as arrays of symbol ids of one SymbolTable
+    :return: the SymbolTable, binary rules as n x 3 (parent, left, right), unary rules as n x 2 (parent, child)
+    and lexical rules as n x 2 (tag, word), one row per occurrence
+    """
+    if symbols is None:
+        symbols = SymbolTable()
+    binary = array('i')
+    unary = array('i')
+    lexical = array('i')
+    for tree in trees:
+        if tree.symbols is not symbols:
+            tree = Tree.from_list(tree.to_list(), symbols)
+        labels = tree.labels
+        arity = tree.arity
+        ends = tree.subtree_ends()
+        for node, num_children in enumerate(arity):
+            if num_children == 2:
+                binary.extend((labels[node], labels[node + 1], labels[ends[node + 1]]))
+            elif num_children == 1:
+                if arity[node + 1]:
+                    unary.extend((labels[node], labels[node + 1]))
+                else:
+                    lexical.extend((labels[node], labels[node + 1]))
+            elif num_children > 2:
+                raise ValueError('Tree is not binarized, {0} has {1} children'.format(tree.label(node),
+                                                                                     num_children))
+    return (symbols, np.frombuffer(binary, dtype=np.int32).reshape(-1, 3),
+            np.frombuffer(unary, dtype=np.int32).reshape(-1, 2),
+            np.frombuffer(lexical, dtype=np.int32).reshape(-1, 2))
+
+
+def _unique_rows(rows, radix):
+    """Returns the distinct rows of a 2d array of ids below radix in sorted order, and their counts"""
+    keys = np.zeros(len(rows), dtype=np.int64)
+    for column in range(rows.shape[1]):
+        keys = keys * radix + rows[:, column]
+    keys, counts = np.unique(keys, return_counts=True)
+    unique = np.empty((len(keys), rows.shape[1]), dtype=np.int32)
+    for column in reversed(range(rows.shape[1])):
+        keys, unique[:, column] = np.divmod(keys, radix)
+    return unique, counts
+
+
+def _pack_strings(strings):
+    """Packs strings into a utf-8 byte array and an array of offsets"""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(blob, offsets):
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _offsets(sorted_ids, size):
+    """Returns the start of every id in a sorted array, plus its length"""
+    return np.searchsorted(sorted_ids, np.arange(size + 1)).astype(np.int64)
+
+
+class Grammar:
+    """PCFG with integer indexed rule tables, see the module docstring for the layout. Nonterminals and words
+    have their own SymbolTable, probabilities are natural logarithms."""
+
+    def __init__(self, nonterminals, words, binary, binary_logprob, unary, unary_logprob, lexical, lexical_logprob,
+                 unknown_logprob):
+        self.nonterminals = nonterminals
+        self.words = words
+        self.binary_parent, self.binary_left, self.binary_right = binary.T
+        self.binary_logprob = binary_logprob
+        self.unary_parent, self.unary_child = unary.T
+        self.unary_logprob = unary_logprob
+        self.lexical_word, self.lexical_tag = lexical.T
+        self.lexical_logprob = lexical_logprob
+        self.unknown_logprob = unknown_logprob
+        self.binary_offsets = _offsets(self.binary_parent, len(nonterminals))
+        self.unary_offsets = _offsets(self.unary_parent, len(nonterminals))
+        self.lexical_offsets = _offsets(self.lexical_word, len(words))
+        self.start = nonterminals.ids.get(START_SYMBOL, -1)
+
+    @classmethod
+    def from_trees(cls, trees, symbols=None):
+        """Estimates the grammar of an iterable of binarized trees"""
+        symbols, binary, unary, lexical = count_rules(trees, symbols)
+
+        # Nonterminals and words in order of their symbol ids
+        nonterminal_ids = np.unique(np.concatenate([binary.ravel(), unary.ravel(), lexical[:, 0]]))
+        word_ids = np.unique(lexical[:, 1])
+        nonterminals = SymbolTable(symbols[idx] for idx in nonterminal_ids.tolist())
+        words = SymbolTable(symbols[idx] for idx in word_ids.tolist())
+        num_nonterminals = len(nonterminals)
+        binary = np.searchsorted(nonterminal_ids, binary)
+        unary = np.searchsorted(nonterminal_ids, unary)
+        lexical = np.column_stack([np.searchsorted(word_ids, lexical[:, 1]),
+                                   np.searchsorted(nonterminal_ids, lexical[:, 0])])
+
+        binary, binary_counts = _unique_rows(binary, num_nonterminals)
+        unary, unary_counts = _unique_rows(unary, num_nonterminals)
+        lexical, lexical_counts = _unique_rows(lexical, max(num_nonterminals, len(words)))
+        totals = (np.bincount(binary[:, 0], binary_counts, num_nonterminals)
+                  + np.bincount(unary[:, 0], unary_counts, num_nonterminals)
+                  + np.bincount(lexical[:, 1], lexical_counts, num_nonterminals))
+
+        word_counts = np.bincount(lexical[:, 0], lexical_counts, len(words))
+        hapax = word_counts[lexical[:, 0]] == 1
+        hapax_counts = np.bincount(lexical[hapax, 1], lexical_counts[hapax], num_nonterminals)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return cls(nonterminals, words,
+                       binary, np.log(binary_counts / totals[binary[:, 0]]),
+                       unary, np.log(unary_counts / totals[unary[:, 0]]),
+                       lexical, np.log(lexical_counts / totals[lexical[:, 1]]),
+                       np.log(hapax_counts / np.maximum(totals, 1)))
+
+    def binary_rules(self, parent):
+        """Returns the (left, right, log probability) arrays of the binary rules of a parent id"""
+        start, end = self.binary_offsets[parent], self.binary_offsets[parent + 1]
+        return self.binary_left[start:end], self.binary_right[start:end], self.binary_logprob[start:end]
+
+    def unary_rules(self, parent):
+        """Returns the (child, log probability) arrays of the unary rules of a parent id"""
+        start, end = self.unary_offsets[parent], self.unary_offsets[parent + 1]
+        return self.unary_child[start:end], self.unary_logprob[start:end]
+
+    def lexical_rules(self, word):
+        """Returns the (tag, log probability) arrays of the tags of a word, for unknown words the tags seen with
+        words that occurred once"""
+        idx = self.words.ids.get(word)
+        if idx is None:
+            tags = np.flatnonzero(self.unknown_logprob > -np.inf)
+            return tags, self.unknown_logprob[tags]
+        start, end = self.lexical_offsets[idx], self.lexical_offsets[idx + 1]
+        return self.lexical_tag[start:end], self.lexical_logprob[start:end]
+
+    def save(self, path):
+        """Saves the grammar to a numpy .npz file"""
+        nonterminals, nonterminal_offsets = _pack_strings(self.nonterminals.symbols)
+        words, word_offsets = _pack_strings(self.words.symbols)
+        with open(path, 'wb') as f:
+            np.savez(f, version=np.array(GRAMMAR_VERSION),
+                     nonterminals=nonterminals, nonterminal_offsets=nonterminal_offsets,
+                     words=words, word_offsets=word_offsets,
+                     binary=np.column_stack([self.binary_parent, self.binary_left, self.binary_right]),
+                     binary_logprob=self.binary_logprob,
+                     unary=np.column_stack([self.unary_parent, self.unary_child]), unary_logprob=self.unary_logprob,
+                     lexical=np.column_stack([self.lexical_word, self.lexical_tag]),
+                     lexical_logprob=self.lexical_logprob, unknown_logprob=self.unknown_logprob)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != GRAMMAR_VERSION:
+                raise ValueError('{0} has grammar version {1}, expected {2}'.format(path, int(data['version']),
+                                                                                    GRAMMAR_VERSION))
+            return cls(SymbolTable(_unpack_strings(data['nonterminals'], data['nonterminal_offsets'])),
+                       SymbolTable(_unpack_strings(data['words'], data['word_offsets'])),
+                       data['binary'].reshape(-1, 3), data['binary_logprob'],
+                       data['unary'].reshape(-1, 2), data['unary_logprob'],
+                       data['lexical'].reshape(-1, 2), data['lexical_logprob'], data['unknown_logprob'])
+
+    def __str__(self):
+        return '{0} nonterminals, {1} words, {2} binary, {3} unary and {4} lexical rules'.format(
+            len(self.nonterminals), len(self.words), len(self.binary_logprob), len(self.unary_logprob),
+            len(self.lexical_logprob))
+
+
+class TestBStep3(unittest.TestCase):
+    def setUp(self):
+        self.trees = [
+            '''(ROOT (S (NP (DT the) (NN dog)) (VP (VBZ barks))))''',
+            '''(ROOT (S (NP (DT the) (NN cat)) (VP (VBZ sees) (NP (DT the) (NN dog)))))''',
+        ]
+
+    def test_rules(self):
+        symbols = SymbolTable()
+        grammar = Grammar.from_trees(parse_tree(tree, symbols) for tree in self.trees)
+        s = grammar.nonterminals.ids['S']
+        np_ = grammar.nonterminals.ids['NP']
+        vp = grammar.nonterminals.ids['VP']
+        left, right, logprob = grammar.binary_rules(s)
+        self.assertEqual((left.tolist(), right.tolist()), ([np_], [vp]))
+        self.assertAlmostEqual(logprob[0], 0.0)
+        child, logprob = grammar.unary_rules(vp)
+        self.assertEqual(child.tolist(), [grammar.nonterminals.ids['VBZ']])
+        self.assertAlmostEqual(np.exp(logprob[0]), 0.5)
+        tags, logprob = grammar.lexical_rules('dog')
+        self.assertEqual(tags.tolist(), [grammar.nonterminals.ids['NN']])
+        self.assertAlmostEqual(np.exp(logprob[0]), 2 / 3)
+        self.assertEqual(grammar.start, grammar.nonterminals.ids['ROOT'])
+
+        # Every parent has a distribution over its rules
+        totals = np.zeros(len(grammar.nonterminals))
+        np.add.at(totals, grammar.binary_parent, np.exp(grammar.binary_logprob))
+        np.add.at(totals, grammar.unary_parent, np.exp(grammar.unary_logprob))
+        np.add.at(totals, grammar.lexical_tag, np.exp(grammar.lexical_logprob))
+        self.assertTrue(np.allclose(totals, 1))
+
+        # Words seen once: barks, cat, sees
+        tags, logprob = grammar.lexical_rules('unseen')
+        self.assertEqual(sorted(grammar.nonterminals[tag] for tag in tags.tolist()), ['NN', 'VBZ'])
+        self.assertAlmostEqual(np.exp(logprob[tags.tolist().index(grammar.nonterminals.ids['VBZ'])]), 1.0)
+
+    def test_save_load(self):
+        grammar = Grammar.from_trees(read_trees(self.trees))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'grammar.npz')
+            grammar.save(path)
+            loaded = Grammar.load(path)
+        self.assertEqual(loaded.nonterminals.symbols, grammar.nonterminals.symbols)
+        self.assertEqual(loaded.words.symbols, grammar.words.symbols)
+        for name in ('binary_parent', 'binary_left', 'binary_right', 'binary_logprob', 'binary_offsets',
+                     'unary_child', 'unary_logprob', 'lexical_tag', 'lexical_logprob', 'lexical_offsets',
+                     'unknown_logprob'):
+            self.assertTrue(np.array_equal(getattr(loaded, name), getattr(grammar, name)), name)
+
+    def test_not_binarized(self):
+        with self.assertRaises(ValueError):
+            Grammar.from_trees(read_trees('(ROOT (NP (DT a) (JJ b) (NN c)))'))
+
+
+def extract_grammar(infile, outfile, h_order=None, v_order=None):
+    """Reads trees from a file, markovizes them when an order is given, and saves their grammar"""
+    with open_text(infile) as f_in, instrument.stage('estimate'):
+        if h_order is not None or v_order is not None:
+            markovizer = Markovizer(h_order, v_order or 1)
+            trees = instrument.timed_iter('markovize', (
+                markovizer.markovize(tree)
+                for tree in instrument.timed_iter('read', read_trees(f_in, markovizer.symbols))))
+            grammar = Grammar.from_trees(trees, markovizer.symbols)
+        else:
+            symbols = SymbolTable()
+            grammar = Grammar.from_trees(instrument.timed_iter('read', read_trees(f_in, symbols)), symbols)
+    with instrument.stage('save'):
+        grammar.save(outfile)
+    instrument.count('rules', len(grammar.binary_logprob) + len(grammar.unary_logprob) + len(grammar.lexical_logprob))
+    print(grammar)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-input', type=str, help='Path to file containing binarized or markovized S-Expressions')
+    parser.add_argument('-output', type=str, help='Path to save the grammar (.npz)')
+    parser.add_argument('-hor', type=int, help='Horizontal markovization of the input trees first')
+    parser.add_argument('-ver', type=int, help='Vertical markovization of the input trees first')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.enable_from_args(args)
+
+    if not args.input and not args.output:
+        unittest.main()
+    else:
+        extract_grammar(args.input, args.output, args.hor, args.ver)
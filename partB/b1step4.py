@@ -0,0 +1,261 @@
+#!/usr/bin/env python3.5
+"""
+CKY parser for a PCFG estimated by b1step3.
+
+The chart holds one vector of log probabilities over all nonterminals per span. A span is filled with array
+operations over the binary rule table: the scores of every rule for every split point at once, the best split per
+rule, and the best rule per parent with one reduction over the rules sorted by parent. Unary rules are then applied
+until no score improves. Backpointers store the rule and split of every entry, the Viterbi tree is written in the
+bracketed format of the training trees.
+"""
+
+import argparse
+import time
+import unittest
+
+import numpy as np
+
+import instrument
+from b1step1 import open_text
+from b1step1 import parse_tree
+from b1step1 import read_trees
+from b1step1 import tokenize_trees
+from b1step3 import Grammar
+
+LEXICAL = 1
+BINARY = 2
+UNARY = 3
+
+
+def _groups(parents, offsets):
+    """Returns the start of every group of rules with the same parent, the parent of every group and the group
+    of every rule"""
+    starts = offsets[:-1][offsets[:-1] < offsets[1:]]
+    group_parents = parents[starts]
+    rule_groups = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(parents))))
+    return starts, group_parents, rule_groups
+
+
+class Parser:
+    """CKY parser over a Grammar, parse returns the bracketed Viterbi tree of a list of words"""
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.num_symbols = len(grammar.nonterminals)
+        self.binary_groups = _groups(grammar.binary_parent, grammar.binary_offsets)
+        self.unary_groups = _groups(grammar.unary_parent, grammar.unary_offsets)
+
+    @staticmethod
+    def _best_per_parent(scores, groups):
+        """Returns the parents, their best score and the index of the rule that gives it"""
+        starts, group_parents, rule_groups = groups
+        best = np.maximum.reduceat(scores, starts)
+        winners = np.flatnonzero(scores == best[rule_groups])
+        _, first = np.unique(rule_groups[winners], return_index=True)
+        found = best > -np.inf
+        return group_parents[found], best[found], winners[first][found]
+
+    def _unary_closure(self, scores, kind, rule, split):
+        """Applies unary rules to the scores of one span until no score improves. No unary logprob is above 0, so
+        a cycle of unary rules never improves a score and every round extends the best chains by one rule: there
+        are at most as many rounds as symbols."""
+        if not len(self.grammar.unary_logprob):
+            return
+        while True:
+            candidates = scores[self.grammar.unary_child] + self.grammar.unary_logprob
+            parents, best, rules = self._best_per_parent(candidates, self.unary_groups)
+            better = best > scores[parents]
+            if not better.any():
+                return
+            parents = parents[better]
+            scores[parents] = best[better]
+            kind[parents] = UNARY
+            rule[parents] = rules[better]
+            split[parents] = -1
+
+    def chart(self, words):
+        """Fills the chart of a sentence
+        :return: scores, and the kind, rule index and split point of every entry, each of shape n+1 x n+1 x symbols
+        """
+        grammar = self.grammar
+        n = len(words)
+        scores = np.full((n + 1, n + 1, self.num_symbols), -np.inf)
+        kind = np.zeros((n + 1, n + 1, self.num_symbols), dtype=np.int8)
+        rule = np.zeros((n + 1, n + 1, self.num_symbols), dtype=np.int32)
+        split = np.zeros((n + 1, n + 1, self.num_symbols), dtype=np.int16)
+
+        for i, word in enumerate(words):
+            tags, logprobs = grammar.lexical_rules(word)
+            scores[i, i + 1, tags] = logprobs
+            kind[i, i + 1, tags] = LEXICAL
+            self._unary_closure(scores[i, i + 1], kind[i, i + 1], rule[i, i + 1], split[i, i + 1])
+
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                j = i + length
+                # Scores of every rule at every split point i < k < j
+                candidates = (scores[i, i + 1:j][:, grammar.binary_left]
+                              + scores[i + 1:j, j][:, grammar.binary_right])
+                best_split = candidates.argmax(axis=0)
+                rule_scores = candidates[best_split, np.arange(len(best_split))] + grammar.binary_logprob
+                parents, best, rules = self._best_per_parent(rule_scores, self.binary_groups)
+                scores[i, j, parents] = best
+                kind[i, j, parents] = BINARY
+                rule[i, j, parents] = rules
+                split[i, j, parents] = i + 1 + best_split[rules]
+                self._unary_closure(scores[i, j], kind[i, j], rule[i, j], split[i, j])
+        return scores, kind, rule, split
+
+    def tree_string(self, words, kind, rule, split, symbol, i=0, j=None):
+        """Returns the bracketed tree of the chart entry of a symbol over words i..j"""
+        grammar = self.grammar
+        symbols = grammar.nonterminals.symbols
+        parts = []
+        stack = [(symbol, i, len(words) if j is None else j)]
+        while stack:
+            item = stack.pop()
+            if item is None:
+                parts.append(')')
+                continue
+            symbol, i, j = item
+            parts.append(' (' + symbols[symbol])
+            stack.append(None)
+            entry = kind[i, j, symbol]
+            if entry == LEXICAL:
+                parts.append(' ' + words[i])
+            elif entry == UNARY:
+                stack.append((int(grammar.unary_child[rule[i, j, symbol]]), i, j))
+            else:
+                k = int(split[i, j, symbol])
+                idx = rule[i, j, symbol]
+                stack.append((int(grammar.binary_right[idx]), k, j))
+                stack.append((int(grammar.binary_left[idx]), i, k))
+        parts[0] = parts[0][1:]
+        return ''.join(parts)
+
+    def parse(self, words):
+        """Returns the bracketed Viterbi tree of a list of words and its log probability, (None, -inf) if the
+        grammar has no tree for them"""
+        if not words:
+            return None, -np.inf
+        scores, kind, rule, split = self.chart(words)
+        start = self.grammar.start
+        logprob = scores[0, len(words), start] if start >= 0 else -np.inf
+        if logprob == -np.inf:
+            return None, -np.inf
+        return self.tree_string(words, kind, rule, split, start), float(logprob)
+
+
+def sentence_words(line):
+    """Returns the words of a line holding a tree, or of a line of space separated words"""
+    if line.lstrip().startswith('('):
+        tree = parse_tree(line)
+        return [tree.label(node) for node in range(len(tree)) if tree.arity[node] == 0]
+    return line.split()
+
+
+def fallback_tree(words):
+    """Flat tree for sentences without a parse, so the output stays aligned with the input"""
+    return '(ROOT ' + ' '.join('(X {0})'.format(word) for word in words) + ')'
+
+
+class TestBStep4(unittest.TestCase):
+    def setUp(self):
+        trees = [
+            '''(ROOT (S (NP (DT the) (NN dog)) (VP (VBZ barks))))''',
+            '''(ROOT (S (NP (DT the) (NN cat)) (VP (VBZ sees) (NP (DT the) (NN dog)))))''',
+            '''(ROOT (S (NP (DT a) (NN cat)) (VP (VBZ sleeps))))''',
+        ]
+        self.grammar = Grammar.from_trees(read_trees(trees))
+        self.parser = Parser(self.grammar)
+
+    def test_parse(self):
+        tree, logprob = self.parser.parse('the cat sees a dog'.split())
+        self.assertEqual(tree, '(ROOT (S (NP (DT the) (NN cat)) (VP (VBZ sees) (NP (DT a) (NN dog)))))')
+        self.assertLess(logprob, 0)
+
+    def test_viterbi_score(self):
+        # Log probability of the tree from the rule tables
+        tree, logprob = self.parser.parse('the dog barks'.split())
+        self.assertEqual(tree, '(ROOT (S (NP (DT the) (NN dog)) (VP (VBZ barks))))')
+        g = self.grammar
+        ids = g.nonterminals.ids
+
+        def rule_logprob(parent, children):
+            if len(children) == 2:
+                left, right, logprobs = g.binary_rules(ids[parent])
+                match = (left == ids[children[0]]) & (right == ids[children[1]])
+            elif children[0] in ids:
+                child, logprobs = g.unary_rules(ids[parent])
+                match = child == ids[children[0]]
+            else:
+                tags, logprobs = g.lexical_rules(children[0])
+                match = tags == ids[parent]
+            return float(logprobs[match][0])
+
+        expected = sum(rule_logprob(parent, children) for parent, children in [
+            ('ROOT', ['S']), ('S', ['NP', 'VP']), ('NP', ['DT', 'NN']), ('VP', ['VBZ']), ('DT', ['the']),
+            ('NN', ['dog']), ('VBZ', ['barks'])])
+        self.assertAlmostEqual(logprob, expected)
+
+    def test_unary_chain(self):
+        # A chain of seven unary rules over a tag, one more rule per round of the closure
+        chain = '(ROOT (A (B (C (D (E (F (G (NN x)))))))))'
+        tree, logprob = Parser(Grammar.from_trees(read_trees([chain]))).parse(['x'])
+        self.assertEqual(tree, chain)
+        self.assertEqual(logprob, 0)
+
+    def test_unknown_and_unparsable(self):
+        tree, _ = self.parser.parse('the dog snores'.split())
+        self.assertEqual(tree, '(ROOT (S (NP (DT the) (NN dog)) (VP (VBZ snores))))')
+        self.assertEqual(self.parser.parse('the the'.split()), (None, -np.inf))
+
+    def test_sentence_words(self):
+        self.assertEqual(sentence_words('(ROOT (S (NP (DT the) (NN dog)) (VP (VBZ barks))))\n'),
+                         ['the', 'dog', 'barks'])
+        self.assertEqual(sentence_words('the dog barks\n'), ['the', 'dog', 'barks'])
+
+
+def parse_file(grammar_file, infile, outfile):
+    """Parses every sentence of a file of trees or of space separated words, writes one tree per line"""
+    with instrument.stage('load'):
+        parser = Parser(Grammar.load(grammar_file))
+    print(parser.grammar)
+    start = time.perf_counter()
+    count = 0
+    failed = 0
+    with open_text(infile) as f_in, open_text(outfile, 'w') as f_out:
+        for line in f_in:
+            with instrument.stage('read'):
+                if not tokenize_trees(line):
+                    continue
+                words = sentence_words(line)
+            with instrument.stage('parse'):
+                tree, _ = parser.parse(words)
+            if tree is None:
+                failed += 1
+                tree = fallback_tree(words)
+            with instrument.stage('serialize'):
+                f_out.write(tree + '\n')
+            count += 1
+            instrument.count('tokens', len(words))
+            instrument.count('chart_cells', len(words) * (len(words) + 1) // 2 * parser.num_symbols)
+    instrument.count('sentences', count)
+    instrument.count('sentences_without_parse', failed)
+    print('Parsed {0} sentences ({1} without parse) in {2:.1f}s'.format(count, failed, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-grammar', type=str, help='Path to a grammar saved by b1step3')
+    parser.add_argument('-input', type=str, help='Path to file with trees or sentences to parse')
+    parser.add_argument('-output', type=str, help='Path to save the parse trees')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.enable_from_args(args)
+
+    if not args.grammar:
+        unittest.main()
+    else:
+        parse_file(args.grammar, args.input, args.output)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3.5
+"""
+PARSEVAL evaluation of parse trees against gold trees.
+
+Trees may be binarized or markovized: @ nodes are left out and the ^ annotations are stripped from the labels
+while the labeled spans are collected, in one traversal of each tree. Like the evaluator of the Java SimpleParser,
+the ROOT label and preterminals are not counted and punctuation, recognised by the gold tags, is left out of the
+span positions.
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import tempfile
+import unittest
+from array import array
+from collections import Counter
+
+import instrument
+from b1step1 import SymbolTable
+from b1step1 import Tree
+from b1step1 import open_text
+from b1step1 import ordered_imap
+from b1step1 import parse_tree
+from b1step1 import tokenize_trees
+from b1step2 import Markovizer
+
+PUNCTUATION_TAGS = frozenset(["''", '``', '.', ':', ','])
+EXCLUDED_LABELS = frozenset(['ROOT'])
+CHUNK_TREES = 500
+
+
+def strip_label(label):
+    """Returns a label without markovization annotation"""
+    return label.split('^', 1)[0]
+
+
+def debinarize(tree, symbols=None):
+    """Returns the original tree of a binarized or markovized Tree: the children of @ nodes are moved up to the
+    parent and annotations are stripped from the labels"""
+    if symbols is None:
+        symbols = tree.symbols
+    in_symbols = tree.symbols.symbols
+    labels = array('i')
+    arity = array('i')
+    stack = []  # [children left, output index of the nearest node that is kept]
+    for label, num_children in zip(tree.labels, tree.arity):
+        if stack:
+            stack[-1][0] -= 1
+        symbol = in_symbols[label]
+        if num_children and symbol.startswith('@'):
+            owner = stack[-1][1] if stack else -1
+        else:
+            if stack:
+                arity[stack[-1][1]] += 1
+            owner = len(labels)
+            labels.append(symbols.add(strip_label(symbol) if num_children else symbol))
+            arity.append(0)
+        if num_children:
+            stack.append([num_children, owner])
+        while stack and stack[-1][0] == 0:
+            del stack[-1]
+    return Tree(symbols, labels, arity)
+
+
+class ParsevalEvaluator:
+    """Labeled bracket precision, recall, F1 and exact match, over the corpus and per label. Trees are added one
+    pair at a time with update, evaluators of parts of a corpus are combined with merge."""
+
+    def __init__(self, punctuation=PUNCTUATION_TAGS, excluded=EXCLUDED_LABELS):
+        self.punctuation = punctuation
+        self.excluded = excluded
+        self.labels = SymbolTable()
+        self._bases = {}
+        self.sentences = 0
+        self.exact = 0
+        self.matched = 0
+        self.gold = 0
+        self.predicted = 0
+        self.label_counts = {}  # label: [matched, gold, predicted]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_bases'] = {}
+        return state
+
+    def _base(self, symbol):
+        """Returns (label id, whether spans of the label are counted) of a nonterminal symbol"""
+        base = self._bases.get(symbol)
+        if base is None:
+            label = strip_label(symbol)
+            base = self._bases[symbol] = (self.labels.add(label),
+                                          not symbol.startswith('@') and label not in self.excluded)
+        return base
+
+    def spans(self, tree):
+        """Returns the words of a tree, the tag of every word and a Counter of its labeled spans (label id, start,
+        end) over all words"""
+        symbols = tree.symbols.symbols
+        arity = tree.arity
+        words = []
+        tags = []
+        spans = Counter()
+        stack = []  # [children left, label id, counted, start]
+        for node, (label, num_children) in enumerate(zip(tree.labels, arity)):
+            if stack:
+                stack[-1][0] -= 1
+            if num_children:
+                label_id, counted = self._base(symbols[label])
+                preterminal = num_children == 1 and arity[node + 1] == 0
+                stack.append([num_children, label_id, counted and not preterminal, len(words)])
+                continue
+            words.append(symbols[label])
+            tags.append(self.labels[stack[-1][1]] if stack else None)
+            while stack and stack[-1][0] == 0:
+                _, label_id, counted, start = stack.pop()
+                if counted:
+                    spans[label_id, start, len(words)] += 1
+        return words, tags, spans
+
+    @staticmethod
+    def _without_positions(spans, positions):
+        """Maps spans to positions without punctuation, leaves out spans that only cover punctuation"""
+        mapped = Counter()
+        for (label_id, start, end), count in spans.items():
+            if positions[start] < positions[end]:
+                mapped[label_id, positions[start], positions[end]] += count
+        return mapped
+
+    def update(self, predicted_tree, gold_tree):
+        """Adds a predicted and a gold tree, as Tree objects or bracketed strings. Punctuation is recognised by the
+        tags of the gold tree."""
+        if isinstance(predicted_tree, str):
+            predicted_tree = parse_tree(predicted_tree)
+        if isinstance(gold_tree, str):
+            gold_tree = parse_tree(gold_tree)
+        predicted_words, _, predicted_spans = self.spans(predicted_tree)
+        gold_words, gold_tags, gold_spans = self.spans(gold_tree)
+        if len(predicted_words) != len(gold_words):
+            raise ValueError('Predicted tree has {0} words, gold tree {1}: {2}'.format(
+                len(predicted_words), len(gold_words), ' '.join(gold_words)))
+        if self.punctuation.intersection(gold_tags):
+            positions = [0]
+            for tag in gold_tags:
+                positions.append(positions[-1] + (tag not in self.punctuation))
+            predicted_spans = self._without_positions(predicted_spans, positions)
+            gold_spans = self._without_positions(gold_spans, positions)
+        matched_spans = predicted_spans & gold_spans
+        self.sentences += 1
+        self.exact += predicted_spans == gold_spans
+        self.matched += sum(matched_spans.values())
+        self.gold += sum(gold_spans.values())
+        self.predicted += sum(predicted_spans.values())
+        for index, spans in enumerate((matched_spans, gold_spans, predicted_spans)):
+            for (label_id, _, _), count in spans.items():
+                self.label_counts.setdefault(self.labels[label_id], [0, 0, 0])[index] += count
+
+    def merge(self, other):
+        """Adds the counts of another evaluator"""
+        self.sentences += other.sentences
+        self.exact += other.exact
+        self.matched += other.matched
+        self.gold += other.gold
+        self.predicted += other.predicted
+        for label, counts in other.label_counts.items():
+            own = self.label_counts.setdefault(label, [0, 0, 0])
+            for index, count in enumerate(counts):
+                own[index] += count
+        return self
+
+    @staticmethod
+    def scores(matched, gold, predicted):
+        """Returns precision, recall and F1"""
+        precision = matched / predicted if predicted else 0.0
+        recall = matched / gold if gold else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        return precision, recall, f1
+
+    def precision_recall_f1(self):
+        return self.scores(self.matched, self.gold, self.predicted)
+
+    def exact_match(self):
+        return self.exact / self.sentences if self.sentences else 0.0
+
+    def per_label(self):
+        """Returns (label, precision, recall, F1, gold count) per label, most frequent in the gold trees first"""
+        return sorted(((label,) + self.scores(*counts) + (counts[1],) for label, counts in self.label_counts.items()),
+                      key=lambda row: (-row[4], row[0]))
+
+    def report(self, per_label=False):
+        precision, recall, f1 = self.precision_recall_f1()
+        lines = ['[Average]  P: {0:.2f} R: {1:.2f} F1: {2:.2f} EX: {3:.1f}'.format(
+            100 * precision, 100 * recall, 100 * f1, 100 * self.exact_match())]
+        if per_label:
+            for label, precision, recall, f1, gold in self.per_label():
+                lines.append('{0:<8} P: {1:6.2f} R: {2:6.2f} F1: {3:6.2f} gold: {4}'.format(
+                    label, 100 * precision, 100 * recall, 100 * f1, gold))
+        return '\n'.join(lines)
+
+
+class TestBStep5(unittest.TestCase):
+    def setUp(self):
+        self.gold = '''(ROOT (S (NP (DT The) (NN dog)) (VP (VBZ sees) (NP (DT a) (JJ big) (NN cat))) (. .)))'''
+        self.predicted = '''(ROOT (S (NP (DT The) (NN dog)) (VP (VBZ sees) (NP (DT a)) (ADJP (JJ big) (NN cat))) (. .)))'''
+
+    def test_debinarize(self):
+        markovizer = Markovizer(2, 2)
+        for sentence in (self.gold, self.predicted):
+            tree = parse_tree(sentence, markovizer.symbols)
+            self.assertEqual(debinarize(markovizer.markovize(tree)).to_string(), sentence)
+
+    def test_spans(self):
+        evaluator = ParsevalEvaluator()
+        words, tags, spans = evaluator.spans(parse_tree(self.gold))
+        self.assertEqual(words, ['The', 'dog', 'sees', 'a', 'big', 'cat', '.'])
+        self.assertEqual(tags, ['DT', 'NN', 'VBZ', 'DT', 'JJ', 'NN', '.'])
+        self.assertEqual(sorted((evaluator.labels[label], start, end) for label, start, end in spans),
+                         [('NP', 0, 2), ('NP', 3, 6), ('S', 0, 7), ('VP', 2, 6)])
+
+    def test_scores(self):
+        evaluator = ParsevalEvaluator()
+        markovized = Markovizer(2, 2).markovize(parse_tree(self.predicted)).to_string()
+        evaluator.update(markovized, self.gold)
+        evaluator.update(self.gold, self.gold)
+        self.assertEqual((evaluator.matched, evaluator.gold, evaluator.predicted), (7, 8, 9))
+        self.assertEqual(evaluator.exact_match(), 0.5)
+        self.assertEqual(evaluator.label_counts['NP'], [3, 4, 4])
+        merged = ParsevalEvaluator().merge(evaluator).merge(evaluator)
+        self.assertEqual(merged.precision_recall_f1(), evaluator.precision_recall_f1())
+        with self.assertRaises(ValueError):
+            evaluator.update('(ROOT (NP (DT a)))', self.gold)
+
+    def test_evaluate_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ('predicted', 'gold', 'extra')]
+            for path, trees in zip(paths, ([self.predicted] * 3, [self.gold] * 3, [self.predicted] * 4)):
+                with open(path, 'w') as f:
+                    f.write('\n'.join(trees) + '\n')
+            for workers in (1, 2):
+                evaluator = evaluate_files(paths[0], paths[1], workers, chunk_size=2)
+                self.assertEqual(evaluator.sentences, 3)
+                # One tree more on either side is an error
+                with self.assertRaises(ValueError):
+                    evaluate_files(paths[2], paths[1], workers, chunk_size=2)
+                with self.assertRaises(ValueError):
+                    evaluate_files(paths[1], paths[2], workers, chunk_size=2)
+
+
+def _tree_lines(f):
+    for line in f:
+        if tokenize_trees(line):
+            yield line
+
+
+def _tree_pairs(predicted_file, gold_file, predicted_lines, gold_lines):
+    """Yields pairs of predicted and gold tree lines, raises ValueError as soon as one file runs out of trees"""
+    for predicted, gold in itertools.zip_longest(predicted_lines, gold_lines):
+        if predicted is None or gold is None:
+            raise ValueError('{0} and {1} do not hold the same number of trees'.format(predicted_file, gold_file))
+        yield predicted, gold
+
+
+def _evaluate_chunk(pairs):
+    evaluator = ParsevalEvaluator()
+    for predicted, gold in pairs:
+        evaluator.update(predicted, gold)
+    return evaluator
+
+
+def evaluate_files(predicted_file, gold_file, workers=1, chunk_size=CHUNK_TREES):
+    """Evaluates a file of predicted trees against a file of gold trees, one tree per line in the same order.
+    With more than one worker chunks of tree pairs are evaluated in a process pool."""
+    evaluator = ParsevalEvaluator()
+    with open_text(predicted_file) as f_predicted, open_text(gold_file) as f_gold:
+        pairs = _tree_pairs(predicted_file, gold_file, _tree_lines(f_predicted), _tree_lines(f_gold))
+        with instrument.stage('evaluate'):
+            if workers > 1:
+                chunks = iter(lambda: [pair for _, pair in zip(range(chunk_size), pairs)], [])
+                with multiprocessing.Pool(workers) as pool:
+                    for chunk_evaluator in ordered_imap(pool, _evaluate_chunk, chunks, 2 * workers):
+                        evaluator.merge(chunk_evaluator)
+            else:
+                for predicted, gold in pairs:
+                    evaluator.update(predicted, gold)
+    instrument.count('sentences', evaluator.sentences)
+    instrument.count('gold_spans', evaluator.gold)
+    instrument.count('predicted_spans', evaluator.predicted)
+    return evaluator
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-predicted', type=str, help='Path to file with parsed trees, may be markovized')
+    parser.add_argument('-gold', type=str, help='Path to file with gold trees')
+    parser.add_argument('-per_label', action='store_true', help='Also print the scores per label')
+    parser.add_argument('-workers', type=int, default=1, help='Number of processes')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.enable_from_args(args)
+
+    if not args.predicted and not args.gold:
+        unittest.main()
+    else:
+        print(evaluate_files(args.predicted, args.gold, args.workers).report(args.per_label))
@@ -0,0 +1,228 @@
+"""
+Instrumentation for the command line scripts: named stage timers, counters, peak resident memory and an optional
+profiler, written as one JSON report with -profile.
+
+    with instrument.stage('count'):
+        ...
+    instrument.count('sentences', len(batch))
+    for item in instrument.timed_iter('decode', items):
+        ...
+
+Stages may nest. Every stage reports its calls, its total wall and cpu time and its self time, which leaves out the
+time of stages nested in it, so the self times of all stages add up to the instrumented part of the run. timed_iter
+only counts the time spent producing items, not the time the loop body spends on them. Until enable is called the
+functions only check a global, so they can stay in the scripts; call them per chunk or sentence, not per cell.
+
+Profilers: cprofile reports the functions with the highest cumulative time, sample interrupts the process every
+sample_interval cpu seconds and counts the stage and function it was in. While it runs the cpu times of short
+stages are coarse.
+"""
+
+import atexit
+import cProfile
+import contextlib
+import json
+import pstats
+import signal
+import sys
+import time
+from collections import Counter
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+PROFILERS = ('cprofile', 'sample')
+TOP_FUNCTIONS = 25
+SAMPLE_INTERVAL = 0.005
+
+_active = None
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def max_rss_bytes(who='self'):
+    """Returns the peak resident memory of this process, or of its finished child processes, None if unknown"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # Kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def _function_name(filename, line, name):
+    return '{0}:{1}({2})'.format(filename, line, name)
+
+
+class Instrumentation:
+    """Collects stage times, counters and profiles of one run"""
+
+    def __init__(self, profiler=None, sample_interval=SAMPLE_INTERVAL):
+        if profiler not in (None,) + PROFILERS:
+            raise ValueError('Unknown profiler {0}, use one of {1}'.format(profiler, ', '.join(PROFILERS)))
+        self.profiler = profiler
+        self.sample_interval = sample_interval
+        self.stages = {}  # name: [calls, seconds, self seconds, cpu seconds, max rss bytes]
+        self.counters = Counter()
+        self.samples = Counter()
+        self._stack = []  # [name, start, cpu start, seconds of nested stages]
+        self._profile = None
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def start_profiler(self):
+        if self.profiler == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.profiler == 'sample':
+            if not hasattr(signal, 'setitimer'):
+                raise RuntimeError('The sampling profiler needs signal.setitimer')
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+
+    def stop_profiler(self):
+        if self._profile is not None:
+            self._profile.disable()
+        elif self.profiler == 'sample':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stage = self._stack[-1][0] if self._stack else None
+        code = frame.f_code
+        self.samples[stage, _function_name(code.co_filename, frame.f_lineno, code.co_name)] += 1
+
+    def enter(self, name):
+        self._stack.append([name, time.perf_counter(), time.process_time(), 0.0])
+
+    def exit(self):
+        name, start, cpu_start, nested = self._stack.pop()
+        seconds = time.perf_counter() - start
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = [0, 0.0, 0.0, 0.0, None]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += seconds - nested
+        stats[3] += time.process_time() - cpu_start
+        stats[4] = max_rss_bytes()
+        if self._stack:
+            self._stack[-1][3] += seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def _profile_report(self):
+        if self._profile is not None:
+            stats = pstats.Stats(self._profile).stats
+            top = sorted(stats.items(), key=lambda item: -item[1][3])[:TOP_FUNCTIONS]
+            return [{'function': _function_name(*function), 'calls': calls, 'seconds': own,
+                     'cumulative_seconds': cumulative}
+                    for function, (_, calls, own, cumulative, _) in top]
+        if self.profiler == 'sample':
+            total = sum(self.samples.values())
+            return [{'stage': stage, 'function': function, 'samples': samples, 'fraction': samples / total}
+                    for (stage, function), samples in self.samples.most_common(TOP_FUNCTIONS)]
+        return None
+
+    def report(self):
+        """Returns the report as a JSON serializable dictionary"""
+        return {
+            'command': sys.argv,
+            'seconds': time.perf_counter() - self._start,
+            'cpu_seconds': time.process_time() - self._cpu_start,
+            'max_rss_bytes': max_rss_bytes(),
+            'children_max_rss_bytes': max_rss_bytes('children'),
+            'stages': {name: {'calls': calls, 'seconds': seconds, 'self_seconds': self_seconds,
+                              'cpu_seconds': cpu_seconds, 'max_rss_bytes': rss}
+                       for name, (calls, seconds, self_seconds, cpu_seconds, rss) in self.stages.items()},
+            'counters': dict(self.counters),
+            'profiler': self.profiler,
+            'profile': self._profile_report(),
+        }
+
+    def write_report(self, path='-'):
+        """Writes the report as JSON to a file, or to stderr for -"""
+        self.stop_profiler()
+        report = self.report()
+        if path == '-':
+            json.dump(report, sys.stderr, indent=2)
+            sys.stderr.write('\n')
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+def enable(profiler=None, sample_interval=SAMPLE_INTERVAL):
+    """Starts instrumenting this process, returns the Instrumentation"""
+    global _active
+    _active = Instrumentation(profiler, sample_interval)
+    _active.start_profiler()
+    return _active
+
+
+def disable():
+    """Stops instrumenting, returns the Instrumentation that was active"""
+    global _active
+    instrumentation, _active = _active, None
+    if instrumentation is not None:
+        instrumentation.stop_profiler()
+    return instrumentation
+
+
+def stage(name):
+    """Context manager timing a named stage"""
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name)
+
+
+def timed_iter(name, iterable):
+    """Iterates over iterable, timing the production of every item as a named stage"""
+    if _active is None:
+        return iterable
+    return _active.timed_iter(name, iterable)
+
+
+def count(name, n=1):
+    """Adds n to a named counter"""
+    if _active is not None:
+        _active.count(name, n)
+
+
+def add_arguments(parser):
+    """Adds -profile and -profiler to an argparse parser"""
+    parser.add_argument('-profile', '--profile', type=str, nargs='?', const='-', metavar='PATH',
+                        help='write a JSON report of stage times, counters and memory to PATH, stderr without PATH')
+    parser.add_argument('-profiler', '--profiler', type=str, choices=PROFILERS,
+                        help='add a cprofile or sampling profile to the -profile report')
+
+
+def enable_from_args(args):
+    """Enables instrumentation when -profile or -profiler was given, the report is written when the process exits"""
+    path = args.profile if args.profile is not None else '-' if args.profiler else None
+    if path is None:
+        return None
+    instrumentation = enable(args.profiler)
+    atexit.register(instrumentation.write_report, path)
+    return instrumentation
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3.5
+"""
+Benchmark of markovization orders: for every (h, v) of a grid, the cost of markovizing a treebank and the size of
+the grammar it gives.
+
+The treebank is read once, every setting markovizes the same compact trees with its own copy of the symbol table.
+Per setting:
+    transform_seconds, transform_peak_bytes    markovizing all trees, peak from tracemalloc in a second run
+    grammar_seconds                            estimating the grammar with b1step3
+    nonterminals, binary_rules, unary_rules, lexical_rules, rules, rule_tokens
+    table_bytes, file_bytes                    grammar arrays in memory and the saved .npz file
+Results are written as JSON (with the run metadata) and/or CSV, one row per setting.
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+import numpy as np
+
+import instrument
+from b1step1 import SymbolTable
+from b1step1 import Tree
+from b1step1 import open_text
+from b1step1 import read_trees
+from b1step2 import Markovizer
+from b1step3 import Grammar
+
+DEFAULT_HORIZONTAL = ['0', '1', '2', '3', 'inf']
+DEFAULT_VERTICAL = [1, 2, 3]
+FIELDS = ['h_order', 'v_order', 'transform_seconds', 'transform_peak_bytes', 'grammar_seconds', 'nonterminals',
+          'binary_rules', 'unary_rules', 'lexical_rules', 'rules', 'rule_tokens', 'table_bytes', 'file_bytes']
+
+
+def horizontal_order(value):
+    """Parses a horizontal order, inf for no horizontal markovization"""
+    return None if value == 'inf' else int(value)
+
+
+def _markovize_all(trees, symbols, h_order, v_order):
+    """Markovizes trees of one SymbolTable with a fresh copy of the table, so settings do not share labels"""
+    markovizer = Markovizer(h_order, v_order, SymbolTable(symbols.symbols))
+    return markovizer, [markovizer.markovize(Tree(markovizer.symbols, tree.labels, tree.arity)) for tree in trees]
+
+
+def benchmark_setting(trees, symbols, h_order, v_order, memory=True):
+    """Returns the measurements of one (h, v) setting as a dictionary with the keys of FIELDS"""
+    start = time.perf_counter()
+    markovizer, markovized = _markovize_all(trees, symbols, h_order, v_order)
+    transform_seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        del markovizer, markovized
+        tracemalloc.start()
+        markovizer, markovized = _markovize_all(trees, symbols, h_order, v_order)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    start = time.perf_counter()
+    grammar = Grammar.from_trees(markovized, markovizer.symbols)
+    grammar_seconds = time.perf_counter() - start
+
+    table_bytes = sum(value.nbytes for value in vars(grammar).values() if isinstance(value, np.ndarray))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'grammar.npz')
+        grammar.save(path)
+        file_bytes = os.path.getsize(path)
+
+    binary, unary, lexical = len(grammar.binary_logprob), len(grammar.unary_logprob), len(grammar.lexical_logprob)
+    return {
+        'h_order': 'inf' if h_order is None else h_order,
+        'v_order': v_order,
+        'transform_seconds': transform_seconds,
+        'transform_peak_bytes': peak,
+        'grammar_seconds': grammar_seconds,
+        'nonterminals': len(grammar.nonterminals),
+        'binary_rules': binary,
+        'unary_rules': unary,
+        'lexical_rules': lexical,
+        'rules': binary + unary + lexical,
+        'rule_tokens': sum(int(np.count_nonzero(np.frombuffer(tree.arity, dtype=np.int32))) for tree in markovized),
+        'table_bytes': table_bytes,
+        'file_bytes': file_bytes,
+    }
+
+
+def run_grid(trees, symbols, h_orders, v_orders, memory=True, verbose=False):
+    """Benchmarks every combination of h_orders and v_orders, returns a list of result dictionaries"""
+    results = []
+    for v_order in v_orders:
+        for h_order in h_orders:
+            result = benchmark_setting(trees, symbols, h_order, v_order, memory)
+            if verbose:
+                print('h={h_order} v={v_order}: {transform_seconds:.2f}s, {nonterminals} nonterminals, '
+                      '{rules} rules, {file_bytes} bytes'.format(**result))
+            results.append(result)
+    return results
+
+
+def write_json(path, results, meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+def write_csv(path, results):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+class TestMarkovBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.trees = [
+            '''(ROOT (S (NP (NNP Ms.) (NNP Haag)) (VP (VBZ plays) (NP (NNP Elianti))) (. .)))''',
+            '''(ROOT (S (NP (DT The) (NN luxury) (NN auto) (NN maker)) (NP (JJ last) (NN year)) (VP (VBD sold) (NP (CD 1,214) (NNS cars)) (PP (IN in) (NP (DT the) (NNP U.S.))))))''',
+        ]
+
+    def test_grid(self):
+        symbols = SymbolTable()
+        trees = list(read_trees(self.trees, symbols))
+        size = len(symbols)
+        results = run_grid(trees, symbols, [1, None], [1, 2])
+        self.assertEqual([(result['h_order'], result['v_order']) for result in results],
+                         [(1, 1), ('inf', 1), (1, 2), ('inf', 2)])
+        self.assertEqual(len(symbols), size)
+        for result in results:
+            self.assertEqual(sorted(result), sorted(FIELDS))
+            self.assertEqual(result['rules'],
+                             result['binary_rules'] + result['unary_rules'] + result['lexical_rules'])
+            self.assertGreater(result['transform_peak_bytes'], 0)
+        # More context gives more nonterminals, the number of rule tokens only depends on h
+        self.assertLess(results[0]['nonterminals'], results[1]['nonterminals'])
+        self.assertLess(results[1]['nonterminals'], results[3]['nonterminals'])
+        self.assertEqual(results[1]['rule_tokens'], results[3]['rule_tokens'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-input', type=str, help='Path to file containing S-Expressions, e.g. data/train20.txt')
+    parser.add_argument('-hor', type=str, nargs='+', default=DEFAULT_HORIZONTAL,
+                        help='Horizontal orders, inf for none')
+    parser.add_argument('-ver', type=int, nargs='+', default=DEFAULT_VERTICAL, help='Vertical orders')
+    parser.add_argument('-json', type=str, help='Path to save the results as JSON')
+    parser.add_argument('-csv', type=str, help='Path to save the results as CSV')
+    parser.add_argument('-no_memory', action='store_true', help='Skip the traced run for peak memory')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.enable_from_args(args)
+
+    if not args.input:
+        unittest.main()
+    else:
+        start = time.perf_counter()
+        symbols = SymbolTable()
+        with open_text(args.input) as f, instrument.stage('read'):
+            trees = list(read_trees(f, symbols))
+        read_seconds = time.perf_counter() - start
+        print('Read {0} trees in {1:.2f}s'.format(len(trees), read_seconds))
+
+        with instrument.stage('grid'):
+            results = run_grid(trees, symbols, [horizontal_order(h) for h in args.hor], args.ver,
+                               not args.no_memory, verbose=True)
+        if args.json:
+            write_json(args.json, results, {
+                'input': args.input,
+                'trees': len(trees),
+                'read_seconds': read_seconds,
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+            })
+        if args.csv:
+            write_csv(args.csv, results)